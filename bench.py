@@ -0,0 +1,414 @@
+import os, sys, asyncio, argparse, base64, json, random, re, signal, statistics, time, logging
+from collections import defaultdict
+from io import BytesIO
+from PIL import Image
+from aiohttp import web, ClientSession
+
+# Нагрузочный стенд: фейковый бэкенд генерации, фейковый Telegram Bot API и драйвер,
+# который гоняет N пользователей по CreateFlow/EditFlow против настоящего main.py.
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("bench")
+
+BOT_TOKEN = "123456:bench"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+
+def make_jpeg(size_kb: int, seed: int = 0) -> bytes:
+    # Шум плохо сжимается — размер файла растёт примерно пропорционально площади
+    rnd = random.Random(seed)
+    side = 64
+    while True:
+        img = Image.frombytes("RGB", (side, side), rnd.randbytes(side * side * 3))
+        out = BytesIO()
+        img.save(out, format="JPEG", quality=90)
+        if out.tell() >= size_kb * 1024 or side >= 4096:
+            return out.getvalue()
+        side *= 2
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo, hi = int(k), min(int(k) + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+def _field_size(field) -> int:
+    field.file.seek(0, os.SEEK_END)
+    return field.file.tell()
+
+# ============ ФЕЙКОВЫЙ БЭКЕНД ============
+class FakeBackend:
+    def __init__(self, latency: float, jitter: float, error_rate: float, payload_kb: int, images: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.images = images
+        self.image_b64 = base64.b64encode(make_jpeg(payload_kb, seed=1)).decode()
+        self.requests = defaultdict(int)
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/api/v1/image/create", self.handle)
+        app.router.add_post("/api/v1/image/edit", self.handle)
+        return app
+
+    async def handle(self, request: web.Request) -> web.Response:
+        await request.read()
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+            if random.random() < self.error_rate:
+                self.requests[f"{request.path} 503"] += 1
+                return web.Response(status=503, text="overloaded")
+            self.requests[f"{request.path} 200"] += 1
+            if request.path.endswith("/create"):
+                return web.json_response({"image_b64": [self.image_b64] * self.images})
+            return web.json_response({"image_b64": self.image_b64})
+        finally:
+            self.in_flight -= 1
+
+# ============ ФЕЙКОВЫЙ TELEGRAM ============
+class FakeTelegram:
+    def __init__(self, photo_kb: int):
+        self.photo = make_jpeg(photo_kb, seed=2)
+        self.updates: list[dict] = []
+        self.update_id = 0
+        self.message_id = 0
+        self.file_id = 0
+        self.outbox: dict[int, list[dict]] = defaultdict(list)
+        self.calls = defaultdict(int)
+        self.uploaded_bytes = 0
+        self.downloaded_bytes = 0
+        self._updates_cond = asyncio.Condition()
+        self._outbox_cond = asyncio.Condition()
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.*}", self.handle_file)
+        return app
+
+    def _user(self, user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def _chat(self, user_id: int) -> dict:
+        return {"id": user_id, "type": "private"}
+
+    def _message(self, chat_id: int, **fields) -> dict:
+        self.message_id += 1
+        return {"message_id": self.message_id, "date": int(time.time()), "chat": self._chat(chat_id), **fields}
+
+    async def push(self, update: dict):
+        async with self._updates_cond:
+            self.update_id += 1
+            self.updates.append({"update_id": self.update_id, **update})
+            self._updates_cond.notify_all()
+
+    async def push_text(self, user_id: int, text: str):
+        await self.push({"message": self._message(user_id, text=text, **{"from": self._user(user_id)})})
+
+    async def push_photo(self, user_id: int):
+        photo = [{"file_id": "bench-photo", "file_unique_id": "bench-photo-u", "width": 1280, "height": 960, "file_size": len(self.photo)}]
+        await self.push({"message": self._message(user_id, photo=photo, **{"from": self._user(user_id)})})
+
+    async def push_callback(self, user_id: int, data: str, message: dict):
+        await self.push({"callback_query": {
+            "id": str(self.update_id + 1), "from": self._user(user_id), "chat_instance": "bench",
+            "data": data, "message": message,
+        }})
+
+    async def wait_for(self, chat_id: int, pattern: str, since: int, timeout: float):
+        # Ждём исходящее сообщение бота в чат, текст которого совпадает с pattern
+        regex = re.compile(pattern)
+        deadline = time.monotonic() + timeout
+        async with self._outbox_cond:
+            while True:
+                for i, message in enumerate(self.outbox[chat_id][since:], start=since):
+                    if regex.search(message.get("text", "")):
+                        return i + 1, message
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise asyncio.TimeoutError(f"чат {chat_id}: не дождались {pattern!r}")
+                try:
+                    await asyncio.wait_for(self._outbox_cond.wait(), remaining)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _record(self, chat_id: int, message: dict):
+        async with self._outbox_cond:
+            self.outbox[chat_id].append(message)
+            self._outbox_cond.notify_all()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        self.calls[method] += 1
+        form = await request.post()
+        if method == "getUpdates":
+            return self._ok(await self._get_updates(form))
+        if method == "getMe":
+            return self._ok(BOT_USER)
+        if method == "getChatMember":
+            return self._ok({"status": "member", "user": self._user(int(form["user_id"]))})
+        if method == "getFile":
+            file_id = form["file_id"]
+            return self._ok({"file_id": file_id, "file_unique_id": f"{file_id}-u", "file_size": len(self.photo), "file_path": f"photos/{file_id}.jpg"})
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(form["chat_id"])
+            markup = json.loads(form.get("reply_markup") or "null")
+            # В ответ Telegram кладёт только inline-клавиатуру
+            extra = {"reply_markup": markup} if markup and "inline_keyboard" in markup else {}
+            message = self._message(chat_id, text=form.get("text", ""), **extra)
+            await self._record(chat_id, message)
+            return self._ok(message)
+        if method == "sendPhoto":
+            chat_id = int(form["chat_id"])
+            file_id = self._store_media(form, form["photo"])
+            message = self._message(chat_id, photo=[{"file_id": file_id, "file_unique_id": f"{file_id}-u", "width": 1024, "height": 1024}])
+            await self._record(chat_id, message)
+            return self._ok(message)
+        if method == "sendMediaGroup":
+            chat_id = int(form["chat_id"])
+            media = json.loads(form["media"])
+            messages = []
+            for item in media:
+                ref = self._store_media(form, item["media"])
+                messages.append(self._message(chat_id, photo=[{"file_id": ref, "file_unique_id": f"{ref}-u", "width": 1024, "height": 1024}]))
+            for message in messages:
+                await self._record(chat_id, message)
+            return self._ok(messages)
+        # deleteMessage, answerCallbackQuery, setWebhook и прочее — просто «ok»
+        return self._ok(True)
+
+    def _store_media(self, form, ref) -> str:
+        # aiogram передаёт файлы как attach://<поле>, уже загруженные — строкой file_id
+        if isinstance(ref, str) and ref.startswith("attach://"):
+            ref = form[ref[len("attach://"):]]
+        if isinstance(ref, str):
+            return ref
+        self.uploaded_bytes += _field_size(ref)
+        self.file_id += 1
+        return f"bench-result-{self.file_id}"
+
+    async def handle_file(self, request: web.Request) -> web.Response:
+        self.downloaded_bytes += len(self.photo)
+        return web.Response(body=self.photo, content_type="image/jpeg")
+
+    async def _get_updates(self, form) -> list:
+        offset = int(form.get("offset") or 0)
+        timeout = float(form.get("timeout") or 0)
+        async with self._updates_cond:
+            pending = [u for u in self.updates if u["update_id"] >= offset]
+            if not pending and timeout:
+                try:
+                    await asyncio.wait_for(self._updates_cond.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                pending = [u for u in self.updates if u["update_id"] >= offset]
+            self.updates = pending
+        return pending[:100]
+
+    @staticmethod
+    def _ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+# ============ ДРАЙВЕР ============
+class Driver:
+    def __init__(self, tg: FakeTelegram, timeout: float, variants: int = 1):
+        self.tg = tg
+        self.timeout = timeout
+        self.variants = variants
+        self.latencies: dict[str, list[float]] = defaultdict(list)
+        self.outcomes = defaultdict(int)
+        self.cursor: dict[int, int] = defaultdict(int)
+
+    async def say(self, user_id: int, text: str, expect: str, timeout: float = 30):
+        await self.tg.push_text(user_id, text)
+        return await self.expect(user_id, expect, timeout)
+
+    async def expect(self, user_id: int, pattern: str, timeout: float):
+        self.cursor[user_id], message = await self.tg.wait_for(user_id, pattern, self.cursor[user_id], timeout)
+        return message
+
+    async def finish(self, user_id: int, flow: str, started: float, pattern: str):
+        message = await self.expect(user_id, f"{pattern}|Сервер перегружен|API не вернуло|Ошибка|Слишком часто|Генерация уже идёт", self.timeout)
+        ok = re.search(pattern, message["text"]) is not None
+        self.outcomes[f"{flow} {'ok' if ok else 'error'}"] += 1
+        if ok:
+            self.latencies[flow].append(time.monotonic() - started)
+
+    async def create_flow(self, user_id: int, prompt: str):
+        await self.say(user_id, "/start", "Akula Bot готов")
+        await self.say(user_id, "✨ Создать", "Опиши картинку")
+        await self.say(user_id, prompt, "Выбери соотношение")
+        await self.say(user_id, "1:1", "Сколько вариантов")
+        await self.say(user_id, str(self.variants), "Запускаем генерацию")
+        started = time.monotonic()
+        await self.tg.push_text(user_id, "✅ Подтвердить")
+        await self.finish(user_id, "create", started, "успешно создано")
+
+    async def edit_flow(self, user_id: int, prompt: str):
+        await self.say(user_id, "/start", "Akula Bot готов")
+        await self.say(user_id, "🎨 Редактировать", "Отправь фото")
+        await self.tg.push_photo(user_id)
+        await self.expect(user_id, "Опиши, как изменить", 60)
+        await self.say(user_id, prompt, "Запускаем редактирование")
+        started = time.monotonic()
+        await self.tg.push_text(user_id, "✅ Подтвердить")
+        await self.finish(user_id, "edit", started, "успешно отредактировано")
+
+    async def run_user(self, user_id: int, flow: str, iterations: int, same_prompt: bool):
+        for i in range(iterations):
+            prompt = "акула в космосе" if same_prompt else f"акула {user_id}-{i}"
+            kind = flow if flow != "mixed" else random.choice(["create", "edit"])
+            try:
+                if kind == "create":
+                    await self.create_flow(user_id, prompt)
+                else:
+                    await self.edit_flow(user_id, prompt)
+            except asyncio.TimeoutError as e:
+                self.outcomes[f"{kind} timeout"] += 1
+                logger.warning("%s", e)
+
+# ============ ЗАПУСК ============
+def read_rss_kb(pid: int) -> dict:
+    rss = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(("VmRSS", "VmHWM")):
+                    name, value = line.split(":")
+                    rss[name] = int(value.split()[0])
+    except FileNotFoundError:
+        pass
+    return rss
+
+def process_tree(pid: int) -> list[int]:
+    # Супервизор и его шарды
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            return [pid] + [int(child) for child in f.read().split()]
+    except FileNotFoundError:
+        return [pid]
+
+async def sample_bot(metrics_urls: list[str], pid: int, samples: dict, stop: asyncio.Event):
+    async with ClientSession() as session:
+        while not stop.is_set():
+            for metrics_url in metrics_urls:
+                try:
+                    async with session.get(metrics_url) as resp:
+                        for line in (await resp.text()).splitlines():
+                            if line.startswith("akula_event_loop_lag_last_seconds "):
+                                samples["lag"].append(float(line.split()[1]))
+                except Exception:
+                    pass
+            samples["rss"].append(sum(read_rss_kb(p).get("VmRSS", 0) for p in process_tree(pid)))
+            try:
+                await asyncio.wait_for(stop.wait(), 0.5)
+            except asyncio.TimeoutError:
+                pass
+
+async def start_site(app: web.Application, port: int) -> web.AppRunner:
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    return runner
+
+async def run(args):
+    backend = FakeBackend(args.latency, args.jitter, args.error_rate, args.payload_kb, args.images)
+    tg = FakeTelegram(args.photo_kb)
+    runners = [await start_site(backend.app(), args.backend_port), await start_site(tg.app(), args.telegram_port)]
+    env = {
+        **os.environ,
+        "BOT_TOKEN": BOT_TOKEN,
+        "TELEGRAM_API_URL": f"http://127.0.0.1:{args.telegram_port}",
+        "API_BASE_URL": f"http://127.0.0.1:{args.backend_port}",
+        "FSM_STORAGE": os.getenv("FSM_STORAGE", "memory"),
+        "METRICS_PORT": str(args.metrics_port),
+        "METRICS_HOST": "127.0.0.1",
+        "LOOP_LAG_INTERVAL_SEC": "0.1",
+        "API_BACKOFF_BASE_SEC": os.getenv("API_BACKOFF_BASE_SEC", "0.2"),
+        "SHARDS": str(args.shards),
+    }
+    bot = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py"), "--mode", "polling",
+        env=env, stdout=asyncio.subprocess.DEVNULL, stderr=None if args.verbose else asyncio.subprocess.DEVNULL,
+    )
+    samples = {"lag": [], "rss": []}
+    stop = asyncio.Event()
+    ports = [args.metrics_port + 1 + i for i in range(args.shards)] if args.shards > 1 else [args.metrics_port]
+    sampler = asyncio.create_task(sample_bot([f"http://127.0.0.1:{port}/metrics" for port in ports], bot.pid, samples, stop))
+    driver = Driver(tg, args.timeout, args.variants)
+    try:
+        await asyncio.sleep(args.warmup)
+        started = time.monotonic()
+        await asyncio.gather(*[driver.run_user(1000 + i, args.flow, args.iterations, args.same_prompt) for i in range(args.users)])
+        elapsed = time.monotonic() - started
+        peak = {"VmHWM": sum(read_rss_kb(p).get("VmHWM", 0) for p in process_tree(bot.pid))}
+    finally:
+        stop.set()
+        await sampler
+        if bot.returncode is None:
+            bot.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(bot.wait(), 15)
+            except asyncio.TimeoutError:
+                bot.kill()
+        for runner in runners:
+            await runner.cleanup()
+
+    completed = sum(len(v) for v in driver.latencies.values())
+    report = {
+        "users": args.users,
+        "shards": args.shards,
+        "flow": args.flow,
+        "elapsed_sec": round(elapsed, 2),
+        "throughput_per_sec": round(completed / elapsed, 3) if elapsed else 0.0,
+        "outcomes": dict(driver.outcomes),
+        "latency_sec": {
+            flow: {
+                "p50": round(percentile(values, 50), 3),
+                "p95": round(percentile(values, 95), 3),
+                "p99": round(percentile(values, 99), 3),
+                "mean": round(statistics.fmean(values), 3),
+            }
+            for flow, values in driver.latencies.items()
+        },
+        "bot_peak_rss_kb": max([peak.get("VmHWM", 0)] + samples["rss"]),
+        "bot_loop_lag_sec": {
+            "max": round(max(samples["lag"], default=0.0), 4),
+            "p95": round(percentile(samples["lag"], 95), 4),
+        },
+        "backend": {"requests": dict(backend.requests), "peak_in_flight": backend.peak_in_flight},
+        "telegram": {"calls": dict(tg.calls), "uploaded_bytes": tg.uploaded_bytes, "downloaded_bytes": tg.downloaded_bytes},
+    }
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return report
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд Akula Bot")
+    parser.add_argument("--users", type=int, default=20, help="число одновременных пользователей")
+    parser.add_argument("--iterations", type=int, default=1, help="сценариев на пользователя")
+    parser.add_argument("--flow", choices=["create", "edit", "mixed"], default="create")
+    parser.add_argument("--same-prompt", action="store_true", help="одинаковый промпт у всех (проверка кэша)")
+    parser.add_argument("--latency", type=float, default=2.0, help="средняя задержка бэкенда, сек")
+    parser.add_argument("--jitter", type=float, default=0.5, help="разброс задержки бэкенда, сек")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 503")
+    parser.add_argument("--payload-kb", type=int, default=1024, help="размер картинки в ответе бэкенда, КБ")
+    parser.add_argument("--images", type=int, default=1, help="картинок в ответе /create")
+    parser.add_argument("--variants", type=int, default=1, choices=[1, 2, 3, 4], help="вариантов в CreateFlow")
+    parser.add_argument("--photo-kb", type=int, default=512, help="размер фото пользователя для EditFlow, КБ")
+    parser.add_argument("--timeout", type=float, default=600, help="таймаут одного сценария, сек")
+    parser.add_argument("--warmup", type=float, default=2.0, help="пауза на запуск бота, сек")
+    parser.add_argument("--shards", type=int, default=1, help="процессов-шардов бота")
+    parser.add_argument("--backend-port", type=int, default=18080)
+    parser.add_argument("--telegram-port", type=int, default=18081)
+    parser.add_argument("--metrics-port", type=int, default=18082)
+    parser.add_argument("--verbose", action="store_true", help="показывать логи бота")
+    return parser.parse_args(argv)
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,12 +1,25 @@
-import os, asyncio, base64, re, httpx, logging
+import os, asyncio, argparse, base64, binascii, time, random, json, hashlib, multiprocessing, signal, sqlite3, ssl, threading, httpx, logging
+from abc import ABC, abstractmethod
+from collections import deque, OrderedDict
+from contextvars import ContextVar
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
 from io import BytesIO
+from queue import Empty
 from PIL import Image
-from aiogram import Bot, Dispatcher, Router, F
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Histogram, REGISTRY, generate_latest
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, Router, F
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey, StateType
 from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiogram.types import Message, CallbackQuery, ChatMemberUpdated, FSInputFile, InputMediaPhoto, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, BufferedInputFile, InlineKeyboardMarkup, InlineKeyboardButton
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -15,6 +28,83 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "YOR TOKEN BOT")
 API_BASE_URL = os.getenv("API_BASE_URL", "https://voiceapi.csv666.ru")
 API_KEY = os.getenv("API_KEY", "YOUR KOD")
 API_TIMEOUT_SEC = 300
+API_CONNECT_TIMEOUT_SEC = float(os.getenv("API_CONNECT_TIMEOUT_SEC", "10"))
+API_READ_TIMEOUT_SEC = float(os.getenv("API_READ_TIMEOUT_SEC", str(API_TIMEOUT_SEC)))
+API_WRITE_TIMEOUT_SEC = float(os.getenv("API_WRITE_TIMEOUT_SEC", "60"))
+API_POOL_TIMEOUT_SEC = float(os.getenv("API_POOL_TIMEOUT_SEC", "30"))
+API_MAX_RESPONSE_BYTES = int(os.getenv("API_MAX_RESPONSE_BYTES", str(64 * 1024 * 1024)))
+API_MAX_CONNECTIONS = int(os.getenv("API_MAX_CONNECTIONS", "50"))
+API_MAX_KEEPALIVE = int(os.getenv("API_MAX_KEEPALIVE", "20"))
+API_KEEPALIVE_EXPIRY_SEC = float(os.getenv("API_KEEPALIVE_EXPIRY_SEC", "60"))
+API_HTTP2 = os.getenv("API_HTTP2", "0") == "1"
+POOL_STATS_INTERVAL_SEC = int(os.getenv("POOL_STATS_INTERVAL_SEC", "0"))
+API_RETRIES = int(os.getenv("API_RETRIES", "3"))
+API_BACKOFF_BASE_SEC = float(os.getenv("API_BACKOFF_BASE_SEC", "1"))
+API_BACKOFF_MAX_SEC = float(os.getenv("API_BACKOFF_MAX_SEC", "30"))
+API_RETRY_AFTER_MAX_SEC = float(os.getenv("API_RETRY_AFTER_MAX_SEC", "60"))
+API_RETRY_BUDGET_RATIO = float(os.getenv("API_RETRY_BUDGET_RATIO", "0.2"))
+API_RETRY_BUDGET_CAPACITY = float(os.getenv("API_RETRY_BUDGET_CAPACITY", "10"))
+CB_FAILURE_THRESHOLD = int(os.getenv("CB_FAILURE_THRESHOLD", "5"))
+CB_RESET_TIMEOUT_SEC = float(os.getenv("CB_RESET_TIMEOUT_SEC", "30"))
+GEN_WORKERS = int(os.getenv("GEN_WORKERS", "4"))
+GEN_PER_USER_LIMIT = int(os.getenv("GEN_PER_USER_LIMIT", "1"))
+GEN_QUEUE_MAX = int(os.getenv("GEN_QUEUE_MAX", "100"))
+SUB_CACHE_TTL_SEC = float(os.getenv("SUB_CACHE_TTL_SEC", "600"))
+SUB_CACHE_NEGATIVE_TTL_SEC = float(os.getenv("SUB_CACHE_NEGATIVE_TTL_SEC", "30"))
+SUB_CACHE_MAX = int(os.getenv("SUB_CACHE_MAX", "50000"))
+SUB_LOOKUP_CONCURRENCY = int(os.getenv("SUB_LOOKUP_CONCURRENCY", "10"))
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")  # memory | sqlite | file
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "akula_fsm.sqlite3")
+FSM_FILE_DIR = os.getenv("FSM_FILE_DIR", "akula_fsm")
+BLOB_TTL_SEC = int(os.getenv("BLOB_TTL_SEC", str(24 * 3600)))
+BLOB_MAX_BYTES = int(os.getenv("BLOB_MAX_BYTES", str(512 * 1024 * 1024)))
+BLOB_GC_INTERVAL_SEC = int(os.getenv("BLOB_GC_INTERVAL_SEC", "60"))
+IMAGE_EXECUTOR = os.getenv("IMAGE_EXECUTOR", "thread")  # thread | process
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 2)))
+EDIT_MAX_SIDE = int(os.getenv("EDIT_MAX_SIDE", "1024"))
+EDIT_FORMAT = os.getenv("EDIT_FORMAT", "jpeg")  # jpeg | progressive | webp
+EDIT_QUALITY = int(os.getenv("EDIT_QUALITY", "85"))
+EDIT_MIN_QUALITY = int(os.getenv("EDIT_MIN_QUALITY", "40"))
+EDIT_TARGET_KB = int(os.getenv("EDIT_TARGET_KB", "0"))  # >0 — подбирать качество под размер
+EDIT_PASSTHROUGH_KB = int(os.getenv("EDIT_PASSTHROUGH_KB", "400"))  # небольшой JPEG уходит без перекодирования
+LOOP_LAG_INTERVAL_SEC = float(os.getenv("LOOP_LAG_INTERVAL_SEC", "0.5"))
+LOOP_LAG_WARN_SEC = float(os.getenv("LOOP_LAG_WARN_SEC", "0.25"))
+API_SUPPORTS_BATCH = os.getenv("API_SUPPORTS_BATCH", "0") == "1"
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "2"))
+MEDIA_GROUP_MAX = 10
+RESULT_CACHE_MAX_BYTES = int(os.getenv("RESULT_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL_SEC = float(os.getenv("RESULT_CACHE_TTL_SEC", "3600"))
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "256"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_SSL_CERT = os.getenv("WEBHOOK_SSL_CERT", "")
+WEBHOOK_SSL_KEY = os.getenv("WEBHOOK_SSL_KEY", "")
+WEBHOOK_SELF_SIGNED = os.getenv("WEBHOOK_SELF_SIGNED", "0") == "1"
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBHOOK_DRAIN_TIMEOUT_SEC = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT_SEC", str(API_TIMEOUT_SEC)))
+MAX_DOWNLOAD_BYTES = int(os.getenv("MAX_DOWNLOAD_BYTES", str(20 * 1024 * 1024)))
+DOWNLOAD_TIMEOUT_SEC = int(os.getenv("DOWNLOAD_TIMEOUT_SEC", "60"))
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text | json
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # в polling-режиме; в webhook /metrics на основном порту
+RATE_USER_PER_MIN = float(os.getenv("RATE_USER_PER_MIN", "4"))  # 0 — без ограничения
+RATE_USER_BURST = float(os.getenv("RATE_USER_BURST", "2"))
+RATE_CREATE_PER_MIN = float(os.getenv("RATE_CREATE_PER_MIN", "120"))
+RATE_EDIT_PER_MIN = float(os.getenv("RATE_EDIT_PER_MIN", "60"))
+RATE_ENDPOINT_BURST = float(os.getenv("RATE_ENDPOINT_BURST", "20"))
+RATE_GLOBAL_PER_MIN = float(os.getenv("RATE_GLOBAL_PER_MIN", "150"))
+RATE_GLOBAL_BURST = float(os.getenv("RATE_GLOBAL_BURST", "30"))
+JOB_PROGRESS_INTERVAL_SEC = float(os.getenv("JOB_PROGRESS_INTERVAL_SEC", "10"))
+SHARDS = int(os.getenv("SHARDS", "1"))  # >1 — супервизор и N процессов-шардов
+SHARED_STATE_PATH = os.getenv("SHARED_STATE_PATH", "akula_shared.sqlite3")
+SHARED_STATE_TIMEOUT_SEC = float(os.getenv("SHARED_STATE_TIMEOUT_SEC", "0.05"))  # ожидание блокировки, дольше — без общего состояния
+SHARD_RESTART_DELAY_SEC = float(os.getenv("SHARD_RESTART_DELAY_SEC", "1"))
+SHARD_PARENT_CHECK_SEC = float(os.getenv("SHARD_PARENT_CHECK_SEC", "1"))  # как часто шард проверяет, жив ли супервизор
 CHANNEL_USERNAME = "@ai_akulaa"
 
 class MainMenu(StatesGroup):
@@ -23,6 +113,7 @@ class MainMenu(StatesGroup):
 class CreateFlow(StatesGroup):
     input_prompt = State()
     select_aspect_ratio = State()
+    select_variants = State()
     confirm = State()
 
 class EditFlow(StatesGroup):
@@ -31,92 +122,1632 @@ class EditFlow(StatesGroup):
     confirm = State()
 
 ASPECT_RATIOS = ["16:9", "9:16", "3:2", "2:3", "4:3", "3:4", "1:1"]
+VARIANT_COUNTS = ["1", "2", "3", "4"]
 BTN_CREATE = KeyboardButton(text="✨ Создать")
 BTN_EDIT = KeyboardButton(text="🎨 Редактировать")
 BTN_BACK = KeyboardButton(text="⬅️ Назад")
 BTN_CONFIRM = KeyboardButton(text="✅ Подтвердить")
 
+# ============ МЕТРИКИ И ЛОГИ ============
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STAGE_SECONDS = Histogram("akula_stage_seconds", "Длительность этапов конвейера генерации", ["stage"], buckets=LATENCY_BUCKETS)
+BACKEND_SECONDS = Histogram("akula_backend_request_seconds", "Длительность запроса к бэкенду", ["endpoint", "attempt"], buckets=LATENCY_BUCKETS)
+BACKEND_RESPONSES = Counter("akula_backend_responses_total", "Ответы бэкенда по статусу", ["endpoint", "status"])
+RATE_LIMITED = Counter("akula_rate_limited_total", "Генерации, отклонённые лимитами", ["scope"])
+SHARED_STATE_ERRORS = Counter("akula_shared_state_errors_total", "Операции с общим состоянием шардов, пропущенные из-за блокировки", ["op"])
+LOOP_LAG_SECONDS = Histogram("akula_event_loop_lag_seconds", "Задержка event loop", buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+def record_stage(stage: str, seconds: float):
+    STAGE_SECONDS.labels(stage).observe(seconds)
+
+def observe_backend(endpoint: str, attempt: int, started: float, status: str):
+    BACKEND_SECONDS.labels(endpoint, str(attempt + 1)).observe(time.perf_counter() - started)
+    BACKEND_RESPONSES.labels(endpoint, status).inc()
+
+class StatsCollector:
+    # Отдаёт в Prometheus счётчики, которые подсистемы и так ведут у себя
+    def __init__(self):
+        self.storage = None
+
+    def describe(self):
+        return []
+
+    def collect(self):
+        gauges = {
+            "akula_http_pool_connections": ("Соединения пула httpx", ["state"], []),
+            "akula_jobs": ("Задачи генерации", ["state"], []),
+            "akula_fsm_users": ("Пользователи с активным состоянием FSM", [], []),
+            "akula_event_loop_lag_last_seconds": ("Последняя измеренная задержка event loop", [], []),
+            "akula_breaker_open": ("1, если цепь эндпоинта разомкнута", ["endpoint"], []),
+            "akula_cache_entries": ("Записи в кэшах", ["cache"], []),
+            "akula_in_flight_updates": ("Апдейты в обработке", [], []),
+            "akula_rate_limit_users": ("Пользователи с неполным token bucket", [], []),
+        }
+        counters = {
+            "akula_breaker_transitions": ("Переходы circuit breaker", ["endpoint", "from_state", "to_state"], []),
+            "akula_backend_retries": ("Повторы запросов к бэкенду", ["endpoint"], []),
+            "akula_cache_lookups": ("Обращения к кэшам", ["cache", "result"], []),
+            "akula_media_bytes": ("Байты, загруженные и скачанные из Telegram", ["direction"], []),
+            "akula_media_reuses": ("Повторные использования картинок без загрузки", ["source"], []),
+            "akula_jobs_cancelled": ("Отменённые генерации", ["reason"], []),
+        }
+        pool = pool_stats()
+        gauges["akula_http_pool_connections"][2].extend([(["active"], pool["active"]), (["idle"], pool["idle"])])
+        jobs = job_queue.stats()
+        gauges["akula_jobs"][2].extend([(["queued"], jobs["depth"]), (["in_flight"], jobs["in_flight"])])
+        detached = generation_jobs.stats()
+        gauges["akula_jobs"][2].append((["detached"], detached["running"]))
+        counters["akula_jobs_cancelled"][2].extend(([reason], count) for reason, count in detached["cancelled"].items())
+        if self.storage is not None:
+            gauges["akula_fsm_users"][2].append(([], count_fsm_users(self.storage)))
+        gauges["akula_event_loop_lag_last_seconds"][2].append(([], loop_lag["last"]))
+        for endpoint, breaker in _breakers.items():
+            gauges["akula_breaker_open"][2].append(([endpoint], int(breaker.state != CircuitBreaker.CLOSED)))
+        gauges["akula_in_flight_updates"][2].append(([], update_limiter.in_flight))
+        gauges["akula_rate_limit_users"][2].append(([], rate_limiter.active_users()))
+        for name, cache in (("subscription", subscription_cache), ("generation", generation_cache)):
+            stats = cache.stats()
+            gauges["akula_cache_entries"][2].append(([name], stats.get("size", stats.get("entries", 0))))
+            counters["akula_cache_lookups"][2].extend([([name, "hit"], stats["hits"]), ([name, "miss"], stats["misses"])])
+        counters["akula_cache_lookups"][2].append((["generation", "coalesced"], generation_cache.coalesced))
+        for (endpoint, old, new), count in breaker_transitions.items():
+            counters["akula_breaker_transitions"][2].append(([endpoint, old, new], count))
+        for endpoint, count in retry_counts.items():
+            counters["akula_backend_retries"][2].append(([endpoint], count))
+        counters["akula_media_bytes"][2].extend([(["uploaded"], media_stats["uploaded_bytes"]), (["downloaded"], media_stats["downloaded_bytes"])])
+        counters["akula_media_reuses"][2].extend([(["file_id"], media_stats["file_id_reuses"]), (["local"], media_stats["local_reuses"])])
+
+        for name, (doc, labels, samples) in gauges.items():
+            family = GaugeMetricFamily(name, doc, labels=labels)
+            for values, value in samples:
+                family.add_metric(values, value)
+            yield family
+        for name, (doc, labels, samples) in counters.items():
+            family = CounterMetricFamily(name, doc, labels=labels)
+            for values, value in samples:
+                family.add_metric(values, value)
+            yield family
+
+stats_collector = StatsCollector()
+REGISTRY.register(stats_collector)
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    return web.Response(body=generate_latest(REGISTRY), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    def format(self, record):
+        payload = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            payload["exc"] = self.formatException(record.exc_info)
+        return json.dumps(payload, ensure_ascii=False)
+
+def configure_logging():
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RequestIdFilter())
+        if LOG_FORMAT == "json":
+            handler.setFormatter(JsonLogFormatter())
+
 def _api_headers():
     return {"x-API-Key": API_KEY, "Content-Type": "application/json"}
 
-def decode_b64_image(b64_str):
-    if not b64_str or not isinstance(b64_str, str):
-        logger.error("decode_b64_image: пустая строка или не строка")
-        return None
-    clean_str = re.sub(r'^data:image/.+;base64,', '', b64_str.strip())
-    missing_padding = len(clean_str) % 4
-    if missing_padding:
-        clean_str += '=' * (4 - missing_padding)
-    try:
-        decoded = base64.b64decode(clean_str)
-        logger.info(f"decode_b64_image: успешно декодировано {len(decoded)} байт")
-        return decoded
-    except Exception as e:
-        logger.error(f"decode_b64_image: ошибка декодирования - {e}")
-        return None
+class StreamingImageDecoder:
+    # Разбирает JSON ответа потоком: строки под ключом key декодируются из base64 кусками
+    # прямо в буфер, остальной (мелкий) JSON копится и парсится целиком в finish()
+    def __init__(self, key: str = "image_b64", max_bytes: int = 0):
+        self.key = key.encode()
+        self.max_bytes = max_bytes
+        self.images: list[BytesIO] = []
+        self.decoded = 0
+        self.decode_seconds = 0.0
+        self._skeleton = bytearray()
+        self._depth = 0
+        self._current_key = None
+        self._last_string = None
+        self._in_array = False
+        self._in_string = False
+        self._escape = False
+        self._string = bytearray()
+        self._image = None
+        self._head = None
+        self._pending = bytearray()
+        self._carry = b""
+
+    def _expect_image(self) -> bool:
+        return (self._depth == 1 and self._current_key == self.key) or (self._depth == 2 and self._in_array)
+
+    def feed(self, chunk: bytes):
+        i, n = 0, len(chunk)
+        while i < n:
+            if self._image is not None:
+                end = chunk.find(b'"', i)
+                self._write_b64(chunk[i:n if end < 0 else end])
+                if end < 0:
+                    return
+                self._close_image()
+                i = end + 1
+            elif self._in_string:
+                i = self._scan_string(chunk, i)
+            else:
+                c = chunk[i]
+                i += 1
+                if c == 0x22:  # "
+                    if self._expect_image():
+                        self._image = BytesIO()
+                        self._head = bytearray()
+                        continue
+                    self._in_string = True
+                    self._string = bytearray()
+                    continue
+                if c in (0x7B, 0x5B):  # { [
+                    self._depth += 1
+                    if c == 0x5B and self._depth == 2 and self._current_key == self.key:
+                        self._in_array = True
+                elif c in (0x7D, 0x5D):  # } ]
+                    if c == 0x5D and self._depth == 2:
+                        self._in_array = False
+                    self._depth -= 1
+                elif c == 0x3A and self._depth == 1:  # :
+                    self._current_key = self._last_string
+                elif c == 0x2C and self._depth == 1:  # ,
+                    self._current_key = None
+                self._skeleton.append(c)
+
+    def _scan_string(self, chunk: bytes, i: int) -> int:
+        n = len(chunk)
+        while i < n:
+            if self._escape:
+                self._string.append(chunk[i])
+                self._escape = False
+                i += 1
+                continue
+            quote = chunk.find(b'"', i)
+            backslash = chunk.find(b"\\", i, n if quote < 0 else quote)
+            if backslash >= 0:
+                self._string += chunk[i:backslash + 1]
+                self._escape = True
+                i = backslash + 1
+                continue
+            if quote < 0:
+                self._string += chunk[i:]
+                return n
+            self._string += chunk[i:quote]
+            self._in_string = False
+            self._last_string = bytes(self._string)
+            self._skeleton += b'"' + self._string + b'"'
+            return quote + 1
+        return n
 
-def compress_image(image_bytes: bytes) -> str:
+    def _write_b64(self, segment: bytes):
+        if self._head is not None:
+            # Отрезаем префикс data:image/...;base64, если он есть
+            self._head += segment
+            if len(self._head) < 5 or (self._head.startswith(b"data:") and b"," not in self._head):
+                return
+            segment = bytes(self._head.partition(b",")[2] if self._head.startswith(b"data:") else self._head)
+            self._head = None
+        segment = self._carry + segment
+        self._carry = b""
+        if segment.endswith(b"\\"):
+            segment, self._carry = segment[:-1], b"\\"
+        if b"\\" in segment:
+            segment = segment.replace(b"\\/", b"/").replace(b"\\n", b"").replace(b"\\r", b"")
+        self._pending += segment
+        usable = len(self._pending) // 4 * 4
+        if usable:
+            self._decode(self._pending[:usable])
+            del self._pending[:usable]
+
+    def _decode(self, data):
+        started = time.perf_counter()
+        decoded = binascii.a2b_base64(data)
+        self.decode_seconds += time.perf_counter() - started
+        self.decoded += len(decoded)
+        if self.max_bytes and self.decoded > self.max_bytes:
+            raise ValueError(f"ответ больше лимита {self.max_bytes} байт")
+        self._image.write(decoded)
+
+    def _close_image(self):
+        if self._head is not None:
+            # Строка короче, чем нужно для проверки префикса
+            head, self._head = bytes(self._head), None
+            self._write_b64(head.partition(b",")[2] if head.startswith(b"data:") else head)
+        if self._pending:
+            self._pending += b"=" * (-len(self._pending) % 4)
+            self._decode(self._pending)
+            self._pending.clear()
+        self._skeleton += str(len(self.images)).encode()
+        self.images.append(self._image)
+        self._image = None
+
+    def finish(self) -> dict:
+        if self._image is not None or self._in_string or self._depth:
+            raise ValueError("ответ API оборван")
+        record_stage("b64_decode", self.decode_seconds)
+        result = json.loads(self._skeleton)
+        value = result.pop(self.key.decode(), None)
+        refs = value if isinstance(value, list) else [] if value is None else [value]
+        result["images"] = [self.images[ref].getvalue() for ref in refs if isinstance(ref, int)]
+        result["images"] = [image for image in result["images"] if image]
+        logger.info("StreamingImageDecoder: декодировано %s байт", self.decoded)
+        return result
+
+async def read_api_response(resp: httpx.Response) -> dict:
+    decoder = StreamingImageDecoder(max_bytes=API_MAX_RESPONSE_BYTES)
+    async for chunk in resp.aiter_bytes():
+        decoder.feed(chunk)
+    return decoder.finish()
+
+class ImageProfile:
+    # Как готовить входную картинку для бэкенда; передаётся и в процессный пул, поэтому простой класс
+    def __init__(self, max_side: int, fmt: str, quality: int, min_quality: int, target_kb: int, passthrough_kb: int):
+        self.max_side = max_side
+        self.format = fmt
+        self.quality = quality
+        self.min_quality = min_quality
+        self.target_bytes = target_kb * 1024
+        self.passthrough_bytes = (target_kb or passthrough_kb) * 1024
+
+EDIT_PROFILE = ImageProfile(EDIT_MAX_SIDE, EDIT_FORMAT, EDIT_QUALITY, EDIT_MIN_QUALITY, EDIT_TARGET_KB, EDIT_PASSTHROUGH_KB)
+
+def pick_photo_size(sizes: list, max_side: int):
+    # Telegram хранит несколько размеров фото — скачиваем наименьший, которого хватает
+    for size in sorted(sizes, key=lambda s: s.width * s.height):
+        if max(size.width, size.height) >= max_side:
+            return size
+    return max(sizes, key=lambda s: s.width * s.height)
+
+def _save_image(img, profile: ImageProfile, quality: int) -> bytes:
+    output = BytesIO()
+    if profile.format == "webp":
+        img.save(output, format='WEBP', quality=quality, method=4)
+    else:
+        img.save(output, format='JPEG', quality=quality, optimize=True, progressive=profile.format == "progressive")
+    return output.getvalue()
+
+def _encode_image(img, profile: ImageProfile) -> bytes:
+    data = _save_image(img, profile, profile.quality)
+    if not profile.target_bytes or len(data) <= profile.target_bytes:
+        return data
+    # Бинарный поиск максимального качества, при котором файл укладывается в бюджет
+    best, lo, hi = None, profile.min_quality, profile.quality - 1
+    while lo <= hi:
+        quality = (lo + hi) // 2
+        candidate = _save_image(img, profile, quality)
+        if len(candidate) <= profile.target_bytes:
+            best, lo = candidate, quality + 1
+        else:
+            data, hi = candidate, quality - 1
+    return best or data
+
+def _compress_image_timed(image_bytes: bytes, profile: ImageProfile = EDIT_PROFILE) -> tuple[bytes, dict]:
+    timings = {}
+    started = time.perf_counter()
+    img = Image.open(BytesIO(image_bytes))
+    max_dimension = profile.max_side
+    if (img.format == 'JPEG' and img.mode in ('RGB', 'L') and max(img.size) <= max_dimension
+            and len(image_bytes) <= profile.passthrough_bytes):
+        # Уже маленький JPEG: перекодирование только потеряет качество и время
+        timings["passthrough"] = time.perf_counter() - started
+        return image_bytes, timings
+    if img.format == 'JPEG' and max(img.size) > max_dimension:
+        # JPEG декодируется сразу в уменьшенном масштабе (1/2, 1/4, 1/8)
+        img.draft('RGB', (max_dimension, max_dimension))
+    img.load()
+    timings["decode"], started = time.perf_counter() - started, time.perf_counter()
+    if img.mode in ('RGBA', 'LA', 'P'):
+        background = Image.new('RGB', img.size, (255, 255, 255))
+        if img.mode == 'P':
+            img = img.convert('RGBA')
+        background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
+        img = background
+    timings["composite"], started = time.perf_counter() - started, time.perf_counter()
+    if max(img.size) > max_dimension:
+        img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
+    timings["resize"], started = time.perf_counter() - started, time.perf_counter()
+    data = _encode_image(img, profile)
+    timings["encode"] = time.perf_counter() - started
+    return data, timings
+
+# ============ ПУЛ ДЛЯ РАБОТЫ С КАРТИНКАМИ ============
+_image_executor: Executor | None = None
+loop_lag = {"last": 0.0}
+
+def get_image_executor() -> Executor:
+    global _image_executor
+    if _image_executor is None:
+        if IMAGE_EXECUTOR == "process":
+            _image_executor = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+        else:
+            _image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+        logger.info("get_image_executor: %s, воркеров: %s", IMAGE_EXECUTOR, IMAGE_WORKERS)
+    return _image_executor
+
+def shutdown_image_executor():
+    global _image_executor
+    if _image_executor is not None:
+        _image_executor.shutdown(wait=False, cancel_futures=True)
+    _image_executor = None
+
+async def compress_image_async(image_bytes: bytes) -> bytes:
+    started = time.perf_counter()
     try:
-        img = Image.open(BytesIO(image_bytes))
-        if img.mode in ('RGBA', 'LA', 'P'):
-            background = Image.new('RGB', img.size, (255, 255, 255))
-            if img.mode == 'P':
-                img = img.convert('RGBA')
-            background.paste(img, mask=img.split()[-1] if img.mode == 'RGBA' else None)
-            img = background
-        max_dimension = 1024
-        if max(img.size) > max_dimension:
-            img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
-        output = BytesIO()
-        img.save(output, format='JPEG', quality=85, optimize=True)
-        return base64.b64encode(output.getvalue()).decode('utf-8')
+        result, timings = await asyncio.get_running_loop().run_in_executor(get_image_executor(), _compress_image_timed, image_bytes)
     except Exception as e:
-        logger.error(f"compress_image: ошибка - {e}")
+        logger.error("compress_image: ошибка - %s", e)
         raise
+    for stage, seconds in timings.items():
+        record_stage(f"compress.{stage}", seconds)
+    record_stage("compress.total", time.perf_counter() - started)
+    return result
+
+async def monitor_loop_lag(interval: float):
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        loop_lag["last"] = lag
+        LOOP_LAG_SECONDS.observe(lag)
+        if lag > LOOP_LAG_WARN_SEC:
+            logger.warning("monitor_loop_lag: event loop задержан на %.3f сек", lag)
+
+# ============ ХРАНИЛИЩЕ FSM ============
+class BlobStore(ABC):
+    # Большие значения (картинки) хранятся один раз, сырыми байтами, по sha256
+    def __init__(self, ttl: int, max_bytes: int, gc_interval: int):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.gc_interval = gc_interval
+        self._last_gc = 0.0
+
+    def put(self, data: bytes) -> str:
+        digest = hashlib.sha256(data).hexdigest()
+        self._write(digest, data)
+        now = time.time()
+        if now - self._last_gc >= self.gc_interval:
+            self._last_gc = now
+            self.gc(now)
+        return digest
+
+    @abstractmethod
+    def get(self, digest: str):
+        """Байты блоба или None, если он вытеснен; только чтение."""
+
+    @abstractmethod
+    def touch(self, digest: str) -> bool:
+        """Продлевает жизнь блоба; False — блоба уже нет."""
+
+    @abstractmethod
+    def _write(self, digest: str, data: bytes):
+        ...
+
+    @abstractmethod
+    def gc(self, now: float):
+        ...
+
+class SQLiteBlobStore(BlobStore):
+    def __init__(self, conn: sqlite3.Connection, ttl: int, max_bytes: int, gc_interval: int):
+        super().__init__(ttl, max_bytes, gc_interval)
+        self.conn = conn
+        conn.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, data BLOB NOT NULL, size INTEGER NOT NULL, accessed REAL NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS blobs_accessed ON blobs (accessed)")
+
+    def _write(self, digest: str, data: bytes):
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO blobs (hash, data, size, accessed) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (hash) DO UPDATE SET accessed = excluded.accessed",
+                (digest, data, len(data), time.time()),
+            )
+
+    def get(self, digest: str):
+        row = self.conn.execute("SELECT data FROM blobs WHERE hash = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def touch(self, digest: str) -> bool:
+        with self.conn:
+            return self.conn.execute("UPDATE blobs SET accessed = ? WHERE hash = ?", (time.time(), digest)).rowcount > 0
+
+    def gc(self, now: float):
+        with self.conn:
+            self.conn.execute("DELETE FROM blobs WHERE accessed < ?", (now - self.ttl,))
+            total = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            for digest, size in self.conn.execute("SELECT hash, size FROM blobs ORDER BY accessed").fetchall():
+                if total <= self.max_bytes:
+                    break
+                self.conn.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+                total -= size
+
+class FileBlobStore(BlobStore):
+    def __init__(self, path: str, ttl: int, max_bytes: int, gc_interval: int):
+        super().__init__(ttl, max_bytes, gc_interval)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _write(self, digest: str, data: bytes):
+        target = os.path.join(self.path, digest)
+        if os.path.exists(target):
+            os.utime(target)
+            return
+        _atomic_write(target, data)
+
+    def get(self, digest: str):
+        try:
+            with open(os.path.join(self.path, digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def touch(self, digest: str) -> bool:
+        try:
+            os.utime(os.path.join(self.path, digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def gc(self, now: float):
+        entries = []
+        for entry in os.scandir(self.path):
+            if not entry.is_file() or entry.name.endswith(".tmp"):
+                continue
+            st = entry.stat()
+            if st.st_mtime < now - self.ttl:
+                os.remove(entry.path)
+            else:
+                entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+def _atomic_write(path: str, data: bytes):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+class BlobRef:
+    # Картинка в BlobStore, которую ещё не читали; байты — через PersistentStorage.load_blob
+    __slots__ = ("digest",)
+
+    def __init__(self, digest: str):
+        self.digest = digest
+
+class PersistentStorage(BaseStorage):
+    # bytes в данных FSM заменяются ссылками на BlobStore, остальное — JSON.
+    # Диск и sqlite работают в отдельном потоке, event loop их не ждёт.
+    BLOB_REF = "__blob__"
+
+    def __init__(self, blobs: BlobStore):
+        self.blobs = blobs
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fsm")
+
+    @abstractmethod
+    def _load(self, key: str):
+        """(state, data JSON) или (None, None)."""
+
+    @abstractmethod
+    def _save(self, key: str, state, data: str):
+        ...
+
+    async def _io(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _pack_value(self, value):
+        if isinstance(value, BlobRef):
+            return {self.BLOB_REF: value.digest}
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return {self.BLOB_REF: self.blobs.put(bytes(value))}
+        if isinstance(value, list):
+            return [self._pack_value(item) for item in value]
+        return value
+
+    def _unpack_value(self, value):
+        # Картинки не читаются, только продлевается их жизнь; вытесненные превращаются в None
+        if isinstance(value, dict) and self.BLOB_REF in value:
+            digest = value[self.BLOB_REF]
+            return BlobRef(digest) if self.blobs.touch(digest) else None
+        if isinstance(value, list):
+            return [self._unpack_value(item) for item in value]
+        return value
+
+    def _pack(self, data: dict) -> str:
+        return json.dumps({name: self._pack_value(value) for name, value in data.items()}, ensure_ascii=False)
+
+    def _unpack(self, raw) -> dict:
+        data = {}
+        for name, packed in json.loads(raw or "{}").items():
+            value = self._unpack_value(packed)
+            if value is None and packed is not None:
+                continue  # картинка вытеснена по TTL/LRU
+            data[name] = value
+        return data
+
+    def _resolve(self, value):
+        if isinstance(value, BlobRef):
+            return self.blobs.get(value.digest)
+        if isinstance(value, list):
+            return [self._resolve(item) for item in value]
+        return value
+
+    def _set_state_sync(self, key: str, state):
+        _, data = self._load(key)
+        self._save(key, state, data)
+
+    def _set_data_sync(self, key: str, data: dict):
+        state, _ = self._load(key)
+        self._save(key, state, self._pack(data))
+
+    def _get_data_sync(self, key: str) -> dict:
+        return self._unpack(self._load(key)[1])
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._io(self._set_state_sync, self.key_builder.build(key), state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey):
+        return (await self._io(self._load, self.key_builder.build(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict) -> None:
+        # Нетронутые BlobRef сохраняются ссылками, без повторного хэширования и записи
+        await self._io(self._set_data_sync, self.key_builder.build(key), dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        # Картинки приходят как BlobRef (или списки с ними), байты — через load_blob
+        return await self._io(self._get_data_sync, self.key_builder.build(key))
+
+    async def load_blob(self, value):
+        # BlobRef -> bytes (None, если вытеснен); списки поэлементно, остальное как есть
+        return await self._io(self._resolve, value)
+
+    async def close(self) -> None:
+        await self._io(self._close)
+        self._executor.shutdown(wait=False)
+
+    def _close(self):
+        pass
+
+class SQLiteStorage(PersistentStorage):
+    def __init__(self, path: str):
+        # conn — только из потока хранилища, read_conn — для метрики из event loop
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS fsm (key TEXT PRIMARY KEY, state TEXT, data TEXT)")
+        self.read_conn = sqlite3.connect(path)
+        super().__init__(SQLiteBlobStore(self.conn, BLOB_TTL_SEC, BLOB_MAX_BYTES, BLOB_GC_INTERVAL_SEC))
+
+    def _load(self, key: str):
+        row = self.conn.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        return row if row else (None, None)
+
+    def _save(self, key: str, state, data):
+        with self.conn:
+            if state is None and data in (None, "{}"):
+                self.conn.execute("DELETE FROM fsm WHERE key = ?", (key,))
+            else:
+                self.conn.execute(
+                    "INSERT INTO fsm (key, state, data) VALUES (?, ?, ?) "
+                    "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data",
+                    (key, state, data),
+                )
+
+    def _close(self):
+        self.conn.close()
+
+    async def close(self) -> None:
+        await super().close()
+        self.read_conn.close()
+
+class FileStorage(PersistentStorage):
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        super().__init__(FileBlobStore(os.path.join(path, "blobs"), BLOB_TTL_SEC, BLOB_MAX_BYTES, BLOB_GC_INTERVAL_SEC))
+
+    def _file(self, key: str) -> str:
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + ".json")
+
+    def _load(self, key: str):
+        try:
+            with open(self._file(key), encoding="utf-8") as f:
+                record = json.load(f)
+        except FileNotFoundError:
+            return None, None
+        return record.get("state"), record.get("data")
+
+    def _save(self, key: str, state, data):
+        if state is None and data in (None, "{}"):
+            try:
+                os.remove(self._file(key))
+            except FileNotFoundError:
+                pass
+            return
+        _atomic_write(self._file(key), json.dumps({"state": state, "data": data}, ensure_ascii=False).encode("utf-8"))
 
-async def api_call(endpoint, payload, retries=3):
+def count_fsm_users(storage: BaseStorage) -> int:
+    if isinstance(storage, SQLiteStorage):
+        return storage.read_conn.execute("SELECT COUNT(*) FROM fsm WHERE state IS NOT NULL").fetchone()[0]
+    if isinstance(storage, FileStorage):
+        return sum(1 for entry in os.scandir(storage.path) if entry.name.endswith(".json"))
+    if isinstance(storage, MemoryStorage):
+        return sum(1 for record in storage.storage.values() if record.state)
+    return 0
+
+async def load_blob(state: FSMContext, value):
+    # Байты картинки из данных FSM: в MemoryStorage они лежат как есть
+    if isinstance(state.storage, PersistentStorage):
+        return await state.storage.load_blob(value)
+    return value
+
+def build_storage() -> BaseStorage:
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage(FSM_SQLITE_PATH)
+    if FSM_STORAGE == "file":
+        return FileStorage(FSM_FILE_DIR)
+    return MemoryStorage()
+
+# ============ ОБЩЕЕ СОСТОЯНИЕ ШАРДОВ ============
+class SharedState:
+    # SQLite в WAL, общая для всех процессов: кэш подписок и token bucket'ы лимитов.
+    # Каждая операция — один оператор, поэтому атомарна без явных транзакций.
+    # Вызывается прямо из event loop, поэтому блокировку ждём недолго, а при
+    # занятой базе работаем без неё: лимиты пропускают, подписка проверяется заново.
+    GC_INTERVAL_SEC = 300
+    IDLE_BUCKET_SEC = 3600
+
+    def __init__(self, path: str, timeout: float = SHARED_STATE_TIMEOUT_SEC):
+        self.conn = sqlite3.connect(path, timeout=timeout, isolation_level=None)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS subscriptions (user_id INTEGER PRIMARY KEY, subscribed INTEGER NOT NULL, expires_at REAL NOT NULL)")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS buckets (name TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)")
+        self._last_gc = 0.0
+
+    def _execute(self, op: str, sql: str, params=()):
+        # None — база занята другим шардом дольше таймаута
+        try:
+            return self.conn.execute(sql, params)
+        except sqlite3.OperationalError as e:
+            SHARED_STATE_ERRORS.labels(op).inc()
+            logger.warning("SharedState.%s: пропускаю - %s", op, e)
+            return None
+
+    def get_subscription(self, user_id: int):
+        # -> (подписан, сколько секунд осталось) или None
+        now = time.time()
+        cur = self._execute("get_subscription", "SELECT subscribed, expires_at FROM subscriptions WHERE user_id = ? AND expires_at > ?", (user_id, now))
+        row = cur.fetchone() if cur else None
+        return (bool(row[0]), row[1] - now) if row else None
+
+    def set_subscription(self, user_id: int, subscribed: bool, ttl: float):
+        now = time.time()
+        self._execute(
+            "set_subscription",
+            "INSERT INTO subscriptions (user_id, subscribed, expires_at) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET subscribed = excluded.subscribed, expires_at = excluded.expires_at",
+            (user_id, int(subscribed), now + ttl),
+        )
+        self._maybe_gc(now)
+
+    def invalidate_subscription(self, user_id: int):
+        self._execute("invalidate_subscription", "DELETE FROM subscriptions WHERE user_id = ?", (user_id,))
+
+    def take(self, name: str, rate: float, capacity: float, cost: float = 1.0) -> bool:
+        # Token bucket: пополняется на rate токенов в секунду до capacity; False — токенов не хватило
+        now = time.time()
+        cur = self._execute(
+            "take",
+            "INSERT INTO buckets (name, tokens, updated) VALUES (:name, :capacity - :cost, :now) "
+            "ON CONFLICT (name) DO UPDATE SET tokens = MIN(:capacity, tokens + (:now - updated) * :rate) - :cost, updated = :now "
+            "WHERE MIN(:capacity, tokens + (:now - updated) * :rate) >= :cost",
+            {"name": name, "rate": rate, "capacity": capacity, "cost": cost, "now": now},
+        )
+        self._maybe_gc(now)
+        return cur is None or cur.rowcount > 0
+
+    def add(self, name: str, amount: float, capacity: float):
+        self._execute(
+            "add",
+            "INSERT INTO buckets (name, tokens, updated) VALUES (:name, :capacity, :now) "
+            "ON CONFLICT (name) DO UPDATE SET tokens = MIN(:capacity, tokens + :amount), updated = :now",
+            {"name": name, "amount": amount, "capacity": capacity, "now": time.time()},
+        )
+
+    def _maybe_gc(self, now: float):
+        if now - self._last_gc < self.GC_INTERVAL_SEC:
+            return
+        self._last_gc = now
+        self._execute("gc", "DELETE FROM subscriptions WHERE expires_at <= ?", (now,))
+        self._execute("gc", "DELETE FROM buckets WHERE updated < ?", (now - self.IDLE_BUCKET_SEC,))
+
+    def close(self):
+        self.conn.close()
+
+shared_state: SharedState | None = None  # есть только в процессах-шардах
+
+# ============ HTTP КЛИЕНТ ============
+http_client: httpx.AsyncClient | None = None
+_http_transport: httpx.AsyncHTTPTransport | None = None
+_pool_wait = {"count": 0, "total": 0.0, "max": 0.0}
+
+def create_http_client() -> httpx.AsyncClient:
+    global http_client, _http_transport
+    http2 = API_HTTP2
+    if http2:
+        try:
+            import h2  # noqa: F401
+        except ImportError:
+            logger.warning("create_http_client: пакет h2 не установлен, HTTP/2 отключён")
+            http2 = False
+    limits = httpx.Limits(
+        max_connections=API_MAX_CONNECTIONS,
+        max_keepalive_connections=API_MAX_KEEPALIVE,
+        keepalive_expiry=API_KEEPALIVE_EXPIRY_SEC,
+    )
+    timeout = httpx.Timeout(
+        connect=API_CONNECT_TIMEOUT_SEC,
+        read=API_READ_TIMEOUT_SEC,
+        write=API_WRITE_TIMEOUT_SEC,
+        pool=API_POOL_TIMEOUT_SEC,
+    )
+    _http_transport = httpx.AsyncHTTPTransport(http2=http2, limits=limits)
+    http_client = httpx.AsyncClient(
+        base_url=API_BASE_URL,
+        headers=_api_headers(),
+        timeout=timeout,
+        transport=_http_transport,
+    )
+    logger.info("create_http_client: пул создан (max=%s, keepalive=%s, http2=%s)", API_MAX_CONNECTIONS, API_MAX_KEEPALIVE, http2)
+    return http_client
+
+def get_http_client() -> httpx.AsyncClient:
+    if http_client is None or http_client.is_closed:
+        return create_http_client()
+    return http_client
+
+async def close_http_client():
+    global http_client, _http_transport
+    if http_client is not None:
+        await http_client.aclose()
+        logger.info("close_http_client: пул закрыт")
+    http_client = None
+    _http_transport = None
+
+def _pool_trace(started_at):
+    # Первое событие httpcore после выдачи соединения из пула — конец ожидания
+    waited = False
+    async def trace(event_name, info):
+        nonlocal waited
+        if waited or not event_name.endswith(".started"):
+            return
+        waited = True
+        wait = time.monotonic() - started_at
+        _pool_wait["count"] += 1
+        _pool_wait["total"] += wait
+        _pool_wait["max"] = max(_pool_wait["max"], wait)
+    return trace
+
+def pool_stats() -> dict:
+    active = idle = 0
+    pool = getattr(_http_transport, "_pool", None)
+    for conn in getattr(pool, "connections", []):
+        if conn.is_closed():
+            continue
+        if conn.is_idle():
+            idle += 1
+        else:
+            active += 1
+    count = _pool_wait["count"]
+    return {
+        "active": active,
+        "idle": idle,
+        "requests": count,
+        "wait_avg_ms": round(_pool_wait["total"] / count * 1000, 2) if count else 0.0,
+        "wait_max_ms": round(_pool_wait["max"] * 1000, 2),
+    }
+
+async def log_pool_stats(interval: int):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("pool_stats: %s", pool_stats())
+
+# ============ УСТОЙЧИВОСТЬ ============
+class CircuitOpenError(Exception):
+    pass
+
+class RetryBudget:
+    # Каждый запрос пополняет бюджет на ratio, каждый повтор тратит 1 токен
+    def __init__(self, ratio: float, capacity: float):
+        self.ratio = ratio
+        self.capacity = capacity
+        self.tokens = capacity
+
+    def deposit(self):
+        self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+class SharedRetryBudget(RetryBudget):
+    # Тот же бюджет, но токены общие для всех шардов: повторы ограничены по всему хосту
+    def __init__(self, shared: SharedState, name: str, ratio: float, capacity: float):
+        super().__init__(ratio, capacity)
+        self.shared = shared
+        self.name = f"retry:{name}"
+
+    def deposit(self):
+        self.shared.add(self.name, self.ratio, self.capacity)
+
+    def withdraw(self) -> bool:
+        return self.shared.take(self.name, 0.0, self.capacity)
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, name: str, failure_threshold: int, reset_timeout: float):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _transition(self, new_state: str):
+        if new_state == self.state:
+            return
+        key = (self.name, self.state, new_state)
+        breaker_transitions[key] = breaker_transitions.get(key, 0) + 1
+        logger.warning("CircuitBreaker %s: %s -> %s", self.name, self.state, new_state)
+        self.state = new_state
+        if new_state == self.OPEN:
+            self.opened_at = time.monotonic()
+
+    def is_open(self) -> bool:
+        return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def before_call(self):
+        if self.state == self.OPEN:
+            if time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{self.name}: цепь разомкнута")
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self._probe_in_flight:
+                raise CircuitOpenError(f"{self.name}: идёт пробный запрос")
+            self._probe_in_flight = True
+
+    def record_success(self):
+        self._probe_in_flight = False
+        self.failures = 0
+        self._transition(self.CLOSED)
+
+    def record_failure(self):
+        self._probe_in_flight = False
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            self._transition(self.OPEN)
+
+    def release(self):
+        self._probe_in_flight = False
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+breaker_transitions: dict[tuple, int] = {}
+retry_counts: dict[str, int] = {}
+_breakers: dict[str, CircuitBreaker] = {}
+_retry_budgets: dict[str, RetryBudget] = {}
+
+def get_breaker(endpoint: str) -> CircuitBreaker:
+    if endpoint not in _breakers:
+        _breakers[endpoint] = CircuitBreaker(endpoint, CB_FAILURE_THRESHOLD, CB_RESET_TIMEOUT_SEC)
+    return _breakers[endpoint]
+
+def get_retry_budget(endpoint: str) -> RetryBudget:
+    if endpoint not in _retry_budgets:
+        if shared_state:
+            _retry_budgets[endpoint] = SharedRetryBudget(shared_state, endpoint, API_RETRY_BUDGET_RATIO, API_RETRY_BUDGET_CAPACITY)
+        else:
+            _retry_budgets[endpoint] = RetryBudget(API_RETRY_BUDGET_RATIO, API_RETRY_BUDGET_CAPACITY)
+    return _retry_budgets[endpoint]
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def _backoff_delay(attempt: int, retry_after=None) -> float:
+    # Full jitter: случайная пауза в [0, base * 2^attempt], не меньше Retry-After
+    delay = random.uniform(0, min(API_BACKOFF_MAX_SEC, API_BACKOFF_BASE_SEC * 2 ** attempt))
+    if retry_after is not None:
+        delay = max(delay, min(retry_after, API_RETRY_AFTER_MAX_SEC))
+    return delay
+
+async def api_call(endpoint, payload, retries=None):
+    retries = API_RETRIES if retries is None else retries
+    breaker = get_breaker(endpoint)
+    budget = get_retry_budget(endpoint)
+    budget.deposit()
     for attempt in range(retries):
+        breaker.before_call()
+        retry_after = None
         try:
-            logger.info(f"api_call: попытка {attempt + 1}/{retries} -> {endpoint}")
-            async with httpx.AsyncClient(timeout=API_TIMEOUT_SEC) as client:
-                resp = await client.post(f"{API_BASE_URL}{endpoint}", json=payload, headers=_api_headers())
-                logger.info(f"api_call: статус = {resp.status_code}")
-
-                # Если сервер перегружен — ждём и пробуем снова
-                if resp.status_code == 503:
-                    if attempt < retries - 1:
-                        logger.warning(f"api_call: 503 Сервер перегружен, ждём 5 сек...")
-                        await asyncio.sleep(5)
-                        continue
-                    else:
+            logger.info("api_call: попытка %s/%s -> %s", attempt + 1, retries, endpoint)
+            client = get_http_client()
+            started = time.perf_counter()
+            status = "transport_error"
+            try:
+                # Тело читается потоком: картинки декодируются кусками, без resp.json() на мегабайты
+                async with client.stream("POST", endpoint, json=payload, extensions={"trace": _pool_trace(time.monotonic())}) as resp:
+                    status = str(resp.status_code)
+                    logger.info("api_call: статус = %s", resp.status_code)
+                    if resp.status_code in RETRYABLE_STATUSES:
+                        retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+                    if resp.is_error:
+                        await resp.aread()
                         resp.raise_for_status()
-
-                resp.raise_for_status()
-                result = resp.json()
-                logger.info(f"api_call: успех, ключи ответа = {result.keys()}")
-                return result
+                    result = await read_api_response(resp)
+            finally:
+                observe_backend(endpoint, attempt, started, status)
+            breaker.record_success()
+            logger.info("api_call: успех, ключи ответа = %s", result.keys())
+            return result
 
         except httpx.HTTPStatusError as e:
-            logger.error(f"api_call: HTTP ошибка {e.response.status_code}: {e.response.text[:500]}")
-            if attempt < retries - 1 and e.response.status_code in [503, 502, 500]:
-                logger.warning(f"api_call: повтор через 5 сек...")
-                await asyncio.sleep(5)
-                continue
+            logger.error("api_call: HTTP ошибка %s: %.500s", e.response.status_code, e.response.text)
+            if e.response.status_code not in RETRYABLE_STATUSES:
+                # Сервер жив и ответил — ошибка запроса, а не бэкенда
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            if attempt >= retries - 1 or breaker.is_open() or not budget.withdraw():
+                raise
+        except httpx.TransportError as e:
+            logger.error("api_call: сетевая ошибка - %r", e)
+            breaker.record_failure()
+            if attempt >= retries - 1 or breaker.is_open() or not budget.withdraw():
+                raise
+        except asyncio.CancelledError:
+            breaker.release()
             raise
         except Exception as e:
-            logger.error(f"api_call: общая ошибка - {e}")
-            if attempt < retries - 1:
-                await asyncio.sleep(5)
+            logger.error("api_call: общая ошибка - %s", e)
+            breaker.record_failure()
+            raise
+
+        retry_counts[endpoint] = retry_counts.get(endpoint, 0) + 1
+        delay = _backoff_delay(attempt, retry_after)
+        logger.warning("api_call: повтор через %.1f сек...", delay)
+        await asyncio.sleep(delay)
+
+# ============ ОЧЕРЕДЬ ГЕНЕРАЦИЙ ============
+class QueueFullError(Exception):
+    pass
+
+class _Job:
+    __slots__ = ("user_id", "factory", "future", "task", "on_position", "position", "user_limit", "request_id", "enqueued_at")
+
+    def __init__(self, user_id, factory, on_position, user_limit=None):
+        self.user_id = user_id
+        self.factory = factory
+        self.user_limit = user_limit
+        self.future = asyncio.get_running_loop().create_future()
+        self.task = None
+        self.on_position = on_position
+        self.position = None
+        self.request_id = request_id_var.get()
+        self.enqueued_at = time.perf_counter()
+
+class JobQueue:
+    def __init__(self, workers: int, per_user_limit: int, max_depth: int):
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.max_depth = max_depth
+        self._pending: dict[int, deque] = {}
+        self._order: deque = deque()  # пользователи с ожидающими задачами, по кругу
+        self._in_flight: dict[int, int] = {}
+        self._depth = 0
+        self._cond = asyncio.Condition()
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info("JobQueue: запущено воркеров: %s", self.workers)
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        for queue in self._pending.values():
+            for job in queue:
+                job.future.cancel()
+        self._pending.clear()
+        self._order.clear()
+        self._depth = 0
+
+    def stats(self) -> dict:
+        return {"depth": self._depth, "in_flight": sum(self._in_flight.values()), "users": len(self._order)}
+
+    async def submit(self, user_id: int, factory, on_position=None, user_limit=None):
+        # user_limit — сколько задач пользователя может выполняться, пока эта первая в его очереди
+        if self._depth >= self.max_depth:
+            logger.warning("JobQueue: очередь переполнена (%s), отказ пользователю %s", self._depth, user_id)
+            raise QueueFullError("очередь переполнена")
+        job = _Job(user_id, factory, on_position, user_limit)
+        async with self._cond:
+            if user_id not in self._pending:
+                self._pending[user_id] = deque()
+                self._order.append(user_id)
+            self._pending[user_id].append(job)
+            self._depth += 1
+            self._cond.notify()
+        self._report_positions()
+        try:
+            return await job.future
+        except asyncio.CancelledError:
+            # Ожидающая задача просто уходит из очереди, выполняющаяся обрывает запрос и отдаёт воркер
+            self._discard(job)
+            if job.task:
+                job.task.cancel()
+            raise
+
+    def _discard(self, job: _Job):
+        queue = self._pending.get(job.user_id)
+        if queue and job in queue:
+            queue.remove(job)
+            self._depth -= 1
+            if not queue:
+                del self._pending[job.user_id]
+                self._order.remove(job.user_id)
+            self._report_positions()
+
+    def _next_job(self):
+        for _ in range(len(self._order)):
+            user_id = self._order[0]
+            self._order.rotate(-1)
+            queue = self._pending[user_id]
+            if self._in_flight.get(user_id, 0) >= (queue[0].user_limit or self.per_user_limit):
                 continue
+            job = queue.popleft()
+            if not queue:
+                del self._pending[user_id]
+                self._order.remove(user_id)
+            self._depth -= 1
+            self._in_flight[user_id] = self._in_flight.get(user_id, 0) + 1
+            return job
+        return None
+
+    def _positions(self) -> dict:
+        # Позиции в порядке выдачи round-robin: по одной задаче от каждого пользователя за круг
+        queues = [self._pending[user_id] for user_id in self._order]
+        positions, pos, rnd = {}, 0, 0
+        while queues:
+            for queue in queues:
+                pos += 1
+                positions[id(queue[rnd])] = pos
+            rnd += 1
+            queues = [queue for queue in queues if len(queue) > rnd]
+        return positions
+
+    def _report_positions(self):
+        positions = self._positions()
+        for queue in self._pending.values():
+            for job in queue:
+                self._notify(job, positions[id(job)])
+
+    def _notify(self, job: _Job, position: int):
+        # on_position вызывается синхронно и должен только запомнить позицию:
+        # при каждом движении очереди он срабатывает у всех задач, чьё место изменилось
+        if job.on_position is None or job.position == position:
+            return
+        job.position = position
+        try:
+            job.on_position(position)
+        except Exception as e:
+            logger.debug("JobQueue: ошибка уведомления о позиции - %s", e)
+
+    async def _worker(self):
+        while True:
+            async with self._cond:
+                job = self._next_job()
+                while job is None:
+                    await self._cond.wait()
+                    job = self._next_job()
+            self._report_positions()
+            try:
+                if job.future.done():
+                    continue
+                self._notify(job, 0)
+                request_id_var.set(job.request_id)
+                record_stage("queue_wait", time.perf_counter() - job.enqueued_at)
+                job.task = asyncio.ensure_future(job.factory())
+                # wait, а не await: отмена самой задачи не должна останавливать воркер
+                await asyncio.wait({job.task})
+                if job.future.done():
+                    continue
+                if job.task.cancelled():
+                    job.future.cancel()
+                elif job.task.exception() is not None:
+                    job.future.set_exception(job.task.exception())
+                else:
+                    job.future.set_result(job.task.result())
+            except asyncio.CancelledError:
+                if job.task:
+                    job.task.cancel()
+                job.future.cancel()
+                raise
+            finally:
+                self._in_flight[job.user_id] -= 1
+                if not self._in_flight[job.user_id]:
+                    del self._in_flight[job.user_id]
+                async with self._cond:
+                    self._cond.notify_all()
+
+job_queue = JobQueue(GEN_WORKERS, GEN_PER_USER_LIMIT, GEN_QUEUE_MAX)
+
+class JobWatchers(set):
+    # Задачи пользователей, которые ждут одну и ту же работу (в т.ч. слитые кэшем).
+    # Позиция в очереди раздаётся всем, кто ещё ждёт, в том числе подключившимся позже.
+    def __init__(self, *jobs):
+        super().__init__()
+        self.position = None
+        for job in jobs:
+            self.add(job)
+
+    def add(self, job):
+        super().add(job)
+        if self.position is not None:
+            job.position = self.position
+
+    def set_position(self, position: int):
+        self.position = position
+        for job in self:
+            job.position = position
+
+async def queued_job(user_id: int, endpoint, factory, on_position, user_limit=None):
+    if get_breaker(endpoint).is_open():
+        raise CircuitOpenError(f"{endpoint}: цепь разомкнута")
+    # Сообщения перерисует периодический _tick задач, а не каждое движение очереди
+    return await job_queue.submit(user_id, factory, on_position, user_limit)
+
+async def queued_api_call(user_id: int, job: "GenerationJob", endpoint, payload):
+    return await queued_job(user_id, endpoint, lambda: api_call(endpoint, payload), JobWatchers(job).set_position)
+
+# ============ ФОНОВЫЕ ГЕНЕРАЦИИ ============
+def kb_cancel_job(job_id: int):
+    return InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="✖️ Отменить", callback_data=f"cancel_job:{job_id}")]])
+
+class GenerationJob:
+    # Генерация живёт своей задачей, а не внутри хендлера: апдейт обработан сразу,
+    # сообщение ожидания показывает очередь или прошедшее время и кнопку отмены
+    def __init__(self, job_id: int, user_id: int, wait_msg: Message):
+        self.id = job_id
+        self.user_id = user_id
+        self.wait_msg = wait_msg
+        self.base_text = wait_msg.html_text
+        self.started = time.monotonic()
+        self.position = None
+        self.task: asyncio.Task | None = None
+        self._shown = None
+
+    def render(self) -> str:
+        if self.position:
+            return f"{self.base_text}\n🕐 <b>Место в очереди:</b> {self.position}"
+        return f"{self.base_text}\n⏱ <b>Прошло:</b> {int(time.monotonic() - self.started)} сек"
+
+    async def refresh(self):
+        text = self.render()
+        if text == self._shown:
+            return
+        self._shown = text
+        await self.wait_msg.edit_text(text, parse_mode="HTML", reply_markup=kb_cancel_job(self.id))
+
+class GenerationJobs:
+    def __init__(self, progress_interval: float):
+        self.progress_interval = progress_interval
+        self._jobs: dict[int, GenerationJob] = {}
+        self._next_id = 0
+        self.cancelled = {"user": 0, "superseded": 0, "shutdown": 0}
+
+    def start(self, user_id: int, wait_msg: Message, run) -> GenerationJob:
+        # run(job) — тело генерации; отмена задачи обрывает HTTP-запрос и освобождает воркер очереди
+        self._next_id += 1
+        job = GenerationJob(self._next_id, user_id, wait_msg)
+        self._jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job, run))
+        return job
+
+    async def _run(self, job: GenerationJob, run):
+        ticker = asyncio.create_task(self._tick(job))
+        try:
+            await run(job)
+        except asyncio.CancelledError:
+            # Результат отменённой генерации никому не нужен: не скачиваем и не загружаем его.
+            # Тикер гасится до правки сообщения, иначе он вернёт «Прошло» и мёртвую кнопку.
+            ticker.cancel()
+            logger.info("GenerationJobs: генерация %s пользователя %s отменена", job.id, job.user_id)
+            try:
+                await job.wait_msg.edit_text("🚫 Генерация отменена")
+            except Exception as e:
+                logger.debug("GenerationJobs: не удалось обновить сообщение - %s", e)
+        finally:
+            ticker.cancel()
+            del self._jobs[job.id]
+
+    async def _tick(self, job: GenerationJob):
+        while True:
+            try:
+                await job.refresh()
+            except Exception as e:
+                # Сообщение ожидания уже удалено (пошла отправка результата) — обновлять нечего
+                logger.debug("GenerationJobs: прогресс больше не обновляется - %s", e)
+                return
+            await asyncio.sleep(self.progress_interval)
+
+    def active(self, user_id: int) -> int:
+        return sum(1 for job in self._jobs.values() if job.user_id == user_id)
+
+    def cancel(self, job_id: int, user_id: int) -> bool:
+        job = self._jobs.get(job_id)
+        if job is None or job.user_id != user_id:
+            return False
+        job.task.cancel()
+        self.cancelled["user"] += 1
+        return True
+
+    def cancel_user(self, user_id: int) -> int:
+        # Пользователь ушёл из сценария — его генерации больше не нужны
+        jobs = [job for job in self._jobs.values() if job.user_id == user_id]
+        for job in jobs:
+            job.task.cancel()
+        self.cancelled["superseded"] += len(jobs)
+        return len(jobs)
+
+    def stats(self) -> dict:
+        return {"running": len(self._jobs), "cancelled": dict(self.cancelled)}
+
+    async def drain(self, timeout: float):
+        tasks = [job.task for job in self._jobs.values()]
+        if not tasks:
+            return
+        logger.info("GenerationJobs: ждём %s генераций", len(tasks))
+        _, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        self.cancelled["shutdown"] += len(pending)
+        if pending:
+            await asyncio.wait(pending)
+
+generation_jobs = GenerationJobs(JOB_PROGRESS_INTERVAL_SEC)
+
+# ============ КЭШ РЕЗУЛЬТАТОВ ============
+class CachedResult:
+    __slots__ = ("images", "file_ids", "expires_at")
+
+    def __init__(self, images, file_ids, expires_at):
+        self.images = images
+        self.file_ids = file_ids
+        self.expires_at = expires_at
+
+    @property
+    def size(self) -> int:
+        # file_id-записи тоже занимают место, иначе бюджет их не ограничит
+        return sum(len(image) for image in self.images or []) + 256 * len(self.file_ids or self.images or [])
+
+class GenerationCache:
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self._in_flight: dict[tuple, asyncio.Future] = {}
+        self._watchers: dict[asyncio.Future, JobWatchers] = {}
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def key(endpoint: str, prompt: str, aspect_ratio: str, variants: int = 1) -> tuple:
+        return endpoint, " ".join(prompt.split()).casefold(), aspect_ratio, variants
+
+    def get(self, key: tuple):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key: tuple, images: list) -> CachedResult:
+        self._remove(key)
+        entry = CachedResult(images, None, time.monotonic() + self.ttl)
+        self._entries[key] = entry
+        self._bytes += entry.size
+        while self._bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+        return entry
+
+    def attach_file_ids(self, key: tuple, file_ids: list):
+        # Фото уже у Telegram — байты больше не нужны, повтор уйдёт по file_id
+        entry = self._entries.get(key)
+        if entry is None or entry.file_ids:
+            return
+        self._bytes -= entry.size
+        entry.file_ids = file_ids
+        entry.images = None
+        self._bytes += entry.size
+
+    def _remove(self, key: tuple):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry.size
+
+    def stats(self) -> dict:
+        return {"entries": len(self._entries), "bytes": self._bytes, "hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
+
+    async def get_or_create(self, key: tuple, factory, watcher, use_cache: bool = True):
+        # factory(watchers) получает живой набор ожидающих задач — прогресс идёт им, а не первому
+        if use_cache:
+            entry = self.get(key)
+            if entry is not None:
+                self.hits += 1
+                return entry
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.coalesced += 1
+                return await self._wait(future, watcher)
+        self.misses += 1
+        watchers = JobWatchers()
+        future = asyncio.ensure_future(self._create(key, factory, watchers))
+        self._watchers[future] = watchers
+        if use_cache:
+            self._in_flight[key] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        return await self._wait(future, watcher)
+
+    async def _wait(self, future: asyncio.Future, watcher):
+        # Общий запрос переживает отмену одного из ожидающих и отменяется вместе с последним
+        watchers = self._watchers[future]
+        watchers.add(watcher)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            watchers.discard(watcher)
+            if not watchers:
+                future.cancel()
             raise
+        finally:
+            watchers.discard(watcher)
+            if not watchers:
+                self._watchers.pop(future, None)
+
+    async def _create(self, key: tuple, factory, watchers):
+        images = await factory(watchers)
+        return self.put(key, images) if images else None
+
+generation_cache = GenerationCache(RESULT_CACHE_MAX_BYTES, RESULT_CACHE_TTL_SEC)
+
+async def create_images(user_id: int, job: GenerationJob, prompt: str, aspect_ratio: str, variants: int = 1, use_cache: bool = True):
+    endpoint = "/api/v1/image/create"
+    key = GenerationCache.key(endpoint, prompt, aspect_ratio, variants)
+    payload = {"prompt": prompt, "aspect_ratio": aspect_ratio}
+
+    async def one():
+        return (await api_call(endpoint, payload)).get("images", [])
+
+    async def factory(watchers):
+        if API_SUPPORTS_BATCH and variants > 1:
+            res = await queued_job(user_id, endpoint, lambda: api_call(endpoint, {**payload, "n": variants}), watchers.set_position)
+            return res.get("images", [])[:MEDIA_GROUP_MAX]
+        # Каждый вариант — своя задача очереди и свой воркер, поэтому запросов к бэкенду
+        # не больше GEN_WORKERS; пользователь занимает до BATCH_CONCURRENCY воркеров сразу
+        positions = {}
+
+        def on_position(index: int):
+            def update(position: int):
+                positions[index] = position
+                watchers.set_position(min(positions.values()))
+            return update
+
+        results = await asyncio.gather(
+            *[queued_job(user_id, endpoint, one, on_position(i), max(GEN_PER_USER_LIMIT, BATCH_CONCURRENCY)) for i in range(variants)],
+            return_exceptions=True,
+        )
+        images = [image for result in results if isinstance(result, list) for image in result]
+        if not images:
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+        # Бэкенд мог вернуть больше картинок, чем просили, — отдаём все, что влезут в альбом
+        return images[:MEDIA_GROUP_MAX]
+
+    return key, await generation_cache.get_or_create(key, factory, job, use_cache)
+
+async def answer_cached_result(message: Message, state: FSMContext, key: tuple, entry: CachedResult, filename: str) -> int:
+    file_ids = await answer_result_photos(message, state, entry.images, filename, entry.file_ids)
+    generation_cache.attach_file_ids(key, file_ids)
+    return len(file_ids)
+
+# ============ МЕДИА ============
+media_stats = {"uploaded_bytes": 0, "downloaded_bytes": 0, "file_id_reuses": 0, "local_reuses": 0}
+
+class FileTooLargeError(Exception):
+    pass
+
+async def answer_result_photos(message: Message, state: FSMContext, images, filename: str, file_ids=None) -> list:
+    # Запоминаем file_id и байты результатов, чтобы «Редактировать» обходилось без загрузки
+    started = time.perf_counter()
+    if file_ids:
+        media = file_ids
+        media_stats["file_id_reuses"] += len(file_ids)
+    else:
+        media = [BufferedInputFile(image, filename=filename) for image in images]
+        media_stats["uploaded_bytes"] += sum(len(image) for image in images)
+    if len(media) == 1:
+        sent = [await message.answer_photo(media[0])]
+    else:
+        sent = await message.answer_media_group([InputMediaPhoto(media=item) for item in media])
+    record_stage("telegram_send_file_id" if file_ids else "telegram_upload", time.perf_counter() - started)
+    file_ids = [m.photo[-1].file_id for m in sent]
+    images = images or [None] * len(file_ids)
+    await state.update_data(
+        last_result=images[0], last_result_file_id=file_ids[0],
+        variant_images=images if len(file_ids) > 1 else None, variant_file_ids=file_ids if len(file_ids) > 1 else None,
+    )
+    return file_ids
+
+async def answer_result_photo(message: Message, state: FSMContext, image: bytes, filename: str) -> str:
+    return (await answer_result_photos(message, state, [image], filename))[0]
+
+async def download_telegram_file(bot: Bot, file_id: str, max_bytes: int = MAX_DOWNLOAD_BYTES) -> bytes:
+    started = time.perf_counter()
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > max_bytes:
+        raise FileTooLargeError(f"файл {file.file_size} байт, лимит {max_bytes}")
+    if bot.session.api.is_local:
+        with open(file.file_path, "rb") as f:
+            data = f.read(max_bytes + 1)
+    else:
+        buf = bytearray()
+        url = bot.session.api.file_url(bot.token, file.file_path)
+        async for chunk in bot.session.stream_content(url=url, timeout=DOWNLOAD_TIMEOUT_SEC, chunk_size=64 * 1024, raise_for_status=True):
+            buf += chunk
+            if len(buf) > max_bytes:
+                break
+        data = bytes(buf)
+    if len(data) > max_bytes:
+        raise FileTooLargeError(f"файл больше лимита {max_bytes} байт")
+    media_stats["downloaded_bytes"] += len(data)
+    record_stage("photo_download", time.perf_counter() - started)
+    return data
+
+async def load_result(bot: Bot, state: FSMContext, index=None):
+    data = await state.get_data()
+    if index is None:
+        image, file_id = data.get("last_result"), data.get("last_result_file_id")
+    else:
+        images, file_ids = data.get("variant_images") or [], data.get("variant_file_ids") or []
+        if not 0 <= index < len(file_ids):
+            return None
+        image, file_id = images[index] if index < len(images) else None, file_ids[index]
+    image = await load_blob(state, image)
+    if image:
+        media_stats["local_reuses"] += 1
+        return image
+    if file_id:
+        return await download_telegram_file(bot, file_id)
+    return None
+
+# ============ ПОДПИСКА ============
+SUBSCRIBED_STATUSES = ["member", "administrator", "creator"]
+
+class SubscriptionCache:
+    def __init__(self, ttl: float, negative_ttl: float, max_size: int, concurrency: int):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._entries: OrderedDict = OrderedDict()  # user_id -> (подписан, истекает)
+        self._in_flight: dict[int, asyncio.Future] = {}
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.shared: SharedState | None = None  # второй уровень, общий для шардов
+        self.hits = 0
+        self.misses = 0
 
-async def check_subscription(bot: Bot, user_id: int) -> bool:
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            subscribed, expires_at = entry
+            if expires_at > time.monotonic():
+                self._entries.move_to_end(user_id)
+                return subscribed
+            del self._entries[user_id]
+        if self.shared:
+            found = self.shared.get_subscription(user_id)
+            if found is not None:
+                self._remember(user_id, found[0], found[1])
+                return found[0]
+        return None
+
+    def set(self, user_id: int, subscribed: bool):
+        ttl = self.ttl if subscribed else self.negative_ttl
+        self._remember(user_id, subscribed, ttl)
+        if self.shared:
+            self.shared.set_subscription(user_id, subscribed, ttl)
+
+    def _remember(self, user_id: int, subscribed: bool, ttl: float):
+        self._entries[user_id] = (subscribed, time.monotonic() + ttl)
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int):
+        self._entries.pop(user_id, None)
+        if self.shared:
+            self.shared.invalidate_subscription(user_id)
+
+    def stats(self) -> dict:
+        return {"size": len(self._entries), "hits": self.hits, "misses": self.misses, "in_flight": len(self._in_flight)}
+
+    async def lookup(self, bot: Bot, user_id: int, fresh: bool = False) -> bool:
+        if not fresh:
+            cached = self.get(user_id)
+            if cached is not None:
+                self.hits += 1
+                return cached
+        self.misses += 1
+        # Параллельные проверки одного пользователя сливаются в один запрос getChatMember
+        future = self._in_flight.get(user_id)
+        if future is None:
+            future = asyncio.ensure_future(self._fetch(bot, user_id))
+            self._in_flight[user_id] = future
+            future.add_done_callback(lambda _: self._in_flight.pop(user_id, None))
+        return await asyncio.shield(future)
+
+    async def _fetch(self, bot: Bot, user_id: int) -> bool:
+        async with self._semaphore:
+            member = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
+        subscribed = member.status in SUBSCRIBED_STATUSES
+        self.set(user_id, subscribed)
+        return subscribed
+
+subscription_cache = SubscriptionCache(SUB_CACHE_TTL_SEC, SUB_CACHE_NEGATIVE_TTL_SEC, SUB_CACHE_MAX, SUB_LOOKUP_CONCURRENCY)
+
+async def check_subscription(bot: Bot, user_id: int, fresh: bool = False) -> bool:
+    started = time.perf_counter()
     try:
-        member = await bot.get_chat_member(chat_id=CHANNEL_USERNAME, user_id=user_id)
-        return member.status in ["member", "administrator", "creator"]
+        return await subscription_cache.lookup(bot, user_id, fresh)
     except Exception as e:
-        logger.error(f"check_subscription: ошибка - {e}")
+        logger.error("check_subscription: ошибка - %s", e)
         return False
+    finally:
+        record_stage("subscription_check", time.perf_counter() - started)
 
 def kb_subscribe():
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -124,13 +1755,18 @@ def kb_subscribe():
         [InlineKeyboardButton(text="✅ Я подписался", callback_data="check_sub")]
     ])
 
-def kb_after_generation(aspect_ratio: str):
-    return InlineKeyboardMarkup(inline_keyboard=[
+def kb_after_generation(aspect_ratio: str, count: int = 1):
+    rows = [
         [InlineKeyboardButton(text="🔄 Перегенерировать", callback_data=f"regenerate:{aspect_ratio}")],
         [InlineKeyboardButton(text="✨ Новая генерация", callback_data="new_generation")],
-        [InlineKeyboardButton(text="🎨 Редактировать результат", callback_data="edit_result")],
-        [InlineKeyboardButton(text="🏠 В меню", callback_data="to_menu")]
-    ])
+    ]
+    if count > 1:
+        buttons = [InlineKeyboardButton(text=f"🎨 №{i + 1}", callback_data=f"edit_variant:{i}") for i in range(count)]
+        rows += [buttons[i:i + 5] for i in range(0, count, 5)]
+    else:
+        rows.append([InlineKeyboardButton(text="🎨 Редактировать результат", callback_data="edit_result")])
+    rows.append([InlineKeyboardButton(text="🏠 В меню", callback_data="to_menu")])
+    return InlineKeyboardMarkup(inline_keyboard=rows)
 
 def kb_after_edit():
     return InlineKeyboardMarkup(inline_keyboard=[
@@ -162,14 +1798,22 @@ async def cmd_start(message: Message, state: FSMContext, bot: Bot):
 
 @router.callback_query(F.data == "check_sub")
 async def check_sub_callback(callback, bot: Bot, state: FSMContext):
-    if not await check_subscription(bot, callback.from_user.id):
+    if not await check_subscription(bot, callback.from_user.id, fresh=True):
         await callback.answer("❌ Ты ещё не подписан!", show_alert=True)
         return
     await callback.message.delete()
     await show_main_menu(callback.message, state)
 
+@router.chat_member()
+async def channel_member_updated(event: ChatMemberUpdated):
+    # Видно, только если бот — администратор канала
+    if not event.chat.username or f"@{event.chat.username}".lower() != CHANNEL_USERNAME.lower():
+        return
+    subscription_cache.set(event.new_chat_member.user.id, event.new_chat_member.status in SUBSCRIBED_STATUSES)
+
 @router.message(F.text == "⬅️ Назад")
 async def back_btn(message: Message, state: FSMContext):
+    generation_jobs.cancel_user(message.from_user.id)
     await show_main_menu(message, state)
 
 # ============ КНОПКИ ПОСЛЕ ГЕНЕРАЦИИ ============
@@ -179,34 +1823,32 @@ async def regenerate_callback(callback, state: FSMContext):
     aspect_ratio = callback.data.split(":")[1]
     await callback.message.delete()
     wait_msg = await callback.message.answer("⚡ <b>Перегенерирую...</b>\n⏳ Пожалуйста, подожди...", parse_mode="HTML")
-    try:
-        res = await api_call("/api/v1/image/create", {
-            "prompt": data["prompt"],
-            "aspect_ratio": aspect_ratio
-        })
-        imgs = res.get("image_b64", [])
-        if isinstance(imgs, str):
-            imgs = [imgs]
-        await wait_msg.delete()
-        if imgs:
-            b = decode_b64_image(imgs[0])
-            if b:
-                await callback.message.answer_photo(BufferedInputFile(b, filename="create.png"))
-        await callback.message.answer(
-            f"⭐ <b>Изображение успешно создано</b>\n\n"
-            f"• <b>Промпт:</b> {data['prompt']}\n"
-            f"• <b>Соотношение сторон:</b> {aspect_ratio}\n\n"
-            f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
-            parse_mode="HTML",
-            reply_markup=kb_after_generation(aspect_ratio)
-        )
-    except Exception as e:
-        await wait_msg.delete()
-        await callback.message.answer(
-            "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
-            parse_mode="HTML",
-            reply_markup=kb_after_generation(aspect_ratio)
-        )
+
+    async def run(job: GenerationJob):
+        count = 0
+        try:
+            # Явная перегенерация — всегда новый результат, мимо кэша
+            key, entry = await create_images(callback.from_user.id, job, data["prompt"], aspect_ratio, data.get("variants", 1), use_cache=False)
+            await wait_msg.delete()
+            if entry:
+                count = await answer_cached_result(callback.message, state, key, entry, "create.png")
+            await callback.message.answer(
+                f"⭐ <b>Изображение успешно создано</b>\n\n"
+                f"• <b>Промпт:</b> {data['prompt']}\n"
+                f"• <b>Соотношение сторон:</b> {aspect_ratio}\n\n"
+                f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
+                parse_mode="HTML",
+                reply_markup=kb_after_generation(aspect_ratio, count)
+            )
+        except Exception as e:
+            await wait_msg.delete()
+            await callback.message.answer(
+                "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
+                parse_mode="HTML",
+                reply_markup=kb_after_generation(aspect_ratio)
+            )
+
+    generation_jobs.start(callback.from_user.id, wait_msg, run)
 
 @router.callback_query(F.data == "new_generation")
 async def new_generation_callback(callback, state: FSMContext):
@@ -215,54 +1857,80 @@ async def new_generation_callback(callback, state: FSMContext):
     await callback.message.answer("📝 Опиши картинку:", reply_markup=ReplyKeyboardMarkup(keyboard=[[BTN_BACK]], resize_keyboard=True))
     await state.set_state(CreateFlow.input_prompt)
 
-@router.callback_query(F.data == "edit_result")
-async def edit_result_callback(callback, state: FSMContext):
+async def edit_last_result(callback, state: FSMContext, bot: Bot, index=None):
     await callback.message.delete()
+    try:
+        image = await load_result(bot, state, index)
+        if image:
+            await state.update_data(image=await compress_image_async(image))
+            await callback.message.answer("📝 Опиши, как изменить изображение:", reply_markup=ReplyKeyboardMarkup(keyboard=[[BTN_BACK]], resize_keyboard=True))
+            await state.set_state(EditFlow.input_prompt)
+            return
+    except Exception as e:
+        logger.error("edit_last_result: ошибка - %s", e)
     await callback.message.answer("📷 Отправь фото для редактирования:", reply_markup=ReplyKeyboardMarkup(keyboard=[[BTN_BACK]], resize_keyboard=True))
     await state.set_state(EditFlow.input_image)
 
+@router.callback_query(F.data == "edit_result")
+async def edit_result_callback(callback, state: FSMContext, bot: Bot):
+    await edit_last_result(callback, state, bot)
+
 @router.callback_query(F.data == "edit_again")
-async def edit_again_callback(callback, state: FSMContext):
-    await callback.message.delete()
-    await callback.message.answer("📷 Отправь фото для редактирования:", reply_markup=ReplyKeyboardMarkup(keyboard=[[BTN_BACK]], resize_keyboard=True))
-    await state.set_state(EditFlow.input_image)
+async def edit_again_callback(callback, state: FSMContext, bot: Bot):
+    await edit_last_result(callback, state, bot)
+
+@router.callback_query(F.data.startswith("edit_variant:"))
+async def edit_variant_callback(callback, state: FSMContext, bot: Bot):
+    await edit_last_result(callback, state, bot, int(callback.data.split(":")[1]))
 
 @router.callback_query(F.data == "re_edit")
 async def re_edit_callback(callback, state: FSMContext):
     data = await state.get_data()
-    if 'image_b64' not in data or 'prompt' not in data:
+    image = await load_blob(state, data.get("image"))
+    if not image or 'prompt' not in data:
         await callback.answer("❌ Данные потеряны. Начни заново.", show_alert=True)
         return
     await callback.message.delete()
     wait_msg = await callback.message.answer("⚡ <b>Обрабатываю фото...</b>\n⏳ Это может занять до 1 минуты", parse_mode="HTML")
-    try:
-        res = await api_call("/api/v1/image/edit", {
-            "reference_image_b64": data["image_b64"],
-            "edit_instruction": data["prompt"]
-        })
-        img_b64 = res.get("image_b64")
-        await wait_msg.delete()
-        if img_b64:
-            b = decode_b64_image(img_b64)
-            if b:
-                await callback.message.answer_photo(BufferedInputFile(b, filename="edited.png"))
-        await callback.message.answer(
-            f"⭐ <b>Изображение успешно отредактировано</b>\n\n"
-            f"• <b>Инструкция:</b> {data['prompt']}\n\n"
-            f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
-            parse_mode="HTML",
-            reply_markup=kb_after_edit()
-        )
-    except Exception as e:
-        await wait_msg.delete()
-        await callback.message.answer(
-            "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
-            parse_mode="HTML",
-            reply_markup=kb_after_edit()
-        )
+
+    async def run(job: GenerationJob):
+        try:
+            res = await queued_api_call(callback.from_user.id, job, "/api/v1/image/edit", {
+                "reference_image_b64": base64.b64encode(image).decode('utf-8'),
+                "edit_instruction": data["prompt"]
+            })
+            imgs = res.get("images", [])
+            await wait_msg.delete()
+            if imgs:
+                await answer_result_photo(callback.message, state, imgs[0], "edited.png")
+            await callback.message.answer(
+                f"⭐ <b>Изображение успешно отредактировано</b>\n\n"
+                f"• <b>Инструкция:</b> {data['prompt']}\n\n"
+                f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
+                parse_mode="HTML",
+                reply_markup=kb_after_edit()
+            )
+        except Exception as e:
+            await wait_msg.delete()
+            await callback.message.answer(
+                "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
+                parse_mode="HTML",
+                reply_markup=kb_after_edit()
+            )
+
+    generation_jobs.start(callback.from_user.id, wait_msg, run)
+
+@router.callback_query(F.data.startswith("cancel_job:"))
+async def cancel_job_callback(callback, state: FSMContext):
+    if not generation_jobs.cancel(int(callback.data.split(":")[1]), callback.from_user.id):
+        await callback.answer("Генерация уже завершена")
+        return
+    await callback.answer("🚫 Отменено")
+    await show_main_menu(callback.message, state)
 
 @router.callback_query(F.data == "to_menu")
 async def to_menu_callback(callback, state: FSMContext):
+    generation_jobs.cancel_user(callback.from_user.id)
     await callback.message.delete()
     await show_main_menu(callback.message, state)
 
@@ -292,12 +1960,26 @@ async def got_aspect(message: Message, state: FSMContext):
         await message.answer("❌ Выбери соотношение сторон из предложенных вариантов")
         return
     await state.update_data(aspect_ratio=message.text)
+    kb = ReplyKeyboardMarkup(keyboard=[
+        [KeyboardButton(text=count) for count in VARIANT_COUNTS],
+        [BTN_BACK]
+    ], resize_keyboard=True)
+    await message.answer("🔢 Сколько вариантов сгенерировать?", reply_markup=kb)
+    await state.set_state(CreateFlow.select_variants)
+
+@router.message(CreateFlow.select_variants)
+async def got_variants(message: Message, state: FSMContext):
+    if message.text not in VARIANT_COUNTS:
+        await message.answer("❌ Выбери количество вариантов из предложенных")
+        return
+    await state.update_data(variants=int(message.text))
     data = await state.get_data()
     kb = ReplyKeyboardMarkup(keyboard=[[BTN_CONFIRM, BTN_BACK]], resize_keyboard=True)
     await message.answer(
         f"🔍 <b>Проверим параметры</b>\n\n"
         f"📝 <b>Промпт:</b> {data['prompt']}\n"
-        f"📐 <b>Соотношение сторон:</b> {data['aspect_ratio']}\n\n"
+        f"📐 <b>Соотношение сторон:</b> {data['aspect_ratio']}\n"
+        f"🔢 <b>Вариантов:</b> {data['variants']}\n\n"
         f"Запускаем генерацию? ⚡",
         parse_mode="HTML",
         reply_markup=kb
@@ -312,38 +1994,34 @@ async def create_confirmed(message: Message, state: FSMContext, bot: Bot):
         return
     data = await state.get_data()
     wait_msg = await message.answer("⚡ <b>Генерирую...</b>\n⏳ Пожалуйста, подожди...", parse_mode="HTML", reply_markup=ReplyKeyboardRemove())
-    try:
-        res = await api_call("/api/v1/image/create", {
-            "prompt": data["prompt"],
-            "aspect_ratio": data["aspect_ratio"]
-        })
-        imgs = res.get("image_b64", [])
-        if isinstance(imgs, str):
-            imgs = [imgs]
-        await wait_msg.delete()
-        if not imgs:
-            await message.answer("❌ API не вернуло изображений")
+
+    async def run(job: GenerationJob):
+        try:
+            key, entry = await create_images(message.from_user.id, job, data["prompt"], data["aspect_ratio"], data.get("variants", 1))
+            await wait_msg.delete()
+            if not entry:
+                await message.answer("❌ API не вернуло изображений")
+                await show_main_menu(message, state)
+                return
+            count = await answer_cached_result(message, state, key, entry, "create.png")
+            await message.answer(
+                f"⭐ <b>Изображение успешно создано</b>\n\n"
+                f"• <b>Промпт:</b> {data['prompt']}\n"
+                f"• <b>Соотношение сторон:</b> {data['aspect_ratio']}\n\n"
+                f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
+                parse_mode="HTML",
+                reply_markup=kb_after_generation(data['aspect_ratio'], count)
+            )
+        except Exception as e:
+            logger.error("create_confirmed: ошибка - %s", e)
+            await wait_msg.delete()
+            await message.answer(
+                "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
+                parse_mode="HTML"
+            )
             await show_main_menu(message, state)
-            return
-        b = decode_b64_image(imgs[0])
-        if b:
-            await message.answer_photo(BufferedInputFile(b, filename="create.png"))
-        await message.answer(
-            f"⭐ <b>Изображение успешно создано</b>\n\n"
-            f"• <b>Промпт:</b> {data['prompt']}\n"
-            f"• <b>Соотношение сторон:</b> {data['aspect_ratio']}\n\n"
-            f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
-            parse_mode="HTML",
-            reply_markup=kb_after_generation(data['aspect_ratio'])
-        )
-    except Exception as e:
-        logger.error(f"create_confirmed: ошибка - {e}")
-        await wait_msg.delete()
-        await message.answer(
-            "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
-            parse_mode="HTML"
-        )
-        await show_main_menu(message, state)
+
+    generation_jobs.start(message.from_user.id, wait_msg, run)
 
 # ============ РЕДАКТИРОВАНИЕ ============
 @router.message(MainMenu.idle, F.text == "🎨 Редактировать")
@@ -357,15 +2035,13 @@ async def start_edit(message: Message, state: FSMContext, bot: Bot):
 @router.message(EditFlow.input_image, F.photo)
 async def edit_got_photo(message: Message, state: FSMContext, bot: Bot):
     try:
-        file = await bot.get_file(message.photo[-1].file_id)
-        bio = BytesIO()
-        await bot.download_file(file.file_path, bio)
-        compressed_b64 = compress_image(bio.getvalue())
-        await state.update_data(image_b64=compressed_b64)
+        photo = await download_telegram_file(bot, pick_photo_size(message.photo, EDIT_PROFILE.max_side).file_id)
+        compressed = await compress_image_async(photo)
+        await state.update_data(image=compressed)
         await message.answer("📝 Опиши, как изменить изображение:", reply_markup=ReplyKeyboardMarkup(keyboard=[[BTN_BACK]], resize_keyboard=True))
         await state.set_state(EditFlow.input_prompt)
     except Exception as e:
-        logger.error(f"edit_got_photo: ошибка - {e}")
+        logger.error("edit_got_photo: ошибка - %s", e)
         await message.answer(f"❌ Ошибка обработки фото: {str(e)}")
 
 @router.message(EditFlow.input_image)
@@ -376,7 +2052,7 @@ async def edit_no_photo(message: Message, state: FSMContext):
 async def edit_got_prompt(message: Message, state: FSMContext):
     await state.update_data(prompt=message.text)
     data = await state.get_data()
-    if 'image_b64' not in data:
+    if 'image' not in data:
         await message.answer("❌ Ошибка: изображение потеряно. Начни заново.")
         await show_main_menu(message, state)
         return
@@ -397,48 +2073,539 @@ async def edit_confirmed(message: Message, state: FSMContext, bot: Bot):
         await state.clear()
         return
     data = await state.get_data()
-    if 'image_b64' not in data:
+    image = await load_blob(state, data.get("image"))
+    if not image:
         await message.answer("❌ Ошибка: изображение потеряно. Начни заново.")
         await show_main_menu(message, state)
         return
     wait_msg = await message.answer("⚡ <b>Обрабатываю фото...</b>\n⏳ Это может занять до 1 минуты", parse_mode="HTML", reply_markup=ReplyKeyboardRemove())
-    try:
-        res = await api_call("/api/v1/image/edit", {
-            "reference_image_b64": data["image_b64"],
-            "edit_instruction": data["prompt"]
-        })
-        img_b64 = res.get("image_b64")
-        await wait_msg.delete()
-        if not img_b64:
-            await message.answer("❌ API не вернуло изображение")
+
+    async def run(job: GenerationJob):
+        try:
+            res = await queued_api_call(message.from_user.id, job, "/api/v1/image/edit", {
+                "reference_image_b64": base64.b64encode(image).decode('utf-8'),
+                "edit_instruction": data["prompt"]
+            })
+            imgs = res.get("images", [])
+            await wait_msg.delete()
+            if not imgs:
+                await message.answer("❌ API не вернуло изображение")
+                await show_main_menu(message, state)
+                return
+            await answer_result_photo(message, state, imgs[0], "edited.png")
+            await message.answer(
+                f"⭐ <b>Изображение успешно отредактировано</b>\n\n"
+                f"• <b>Инструкция:</b> {data['prompt']}\n\n"
+                f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
+                parse_mode="HTML",
+                reply_markup=kb_after_edit()
+            )
+        except Exception as e:
+            logger.error("edit_confirmed: ошибка - %s", e, exc_info=True)
+            await wait_msg.delete()
+            await message.answer(
+                "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
+                parse_mode="HTML"
+            )
             await show_main_menu(message, state)
+
+    generation_jobs.start(message.from_user.id, wait_msg, run)
+
+# ============ ЛИМИТЫ ============
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        # now мог быть взят до создания ведра
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def take(self, now: float, cost: float = 1) -> bool:
+        # Дороже запаса не бывает: иначе такой запрос не прошёл бы никогда
+        cost = min(cost, self.capacity)
+        self._refill(now)
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+    def refund(self, cost: float = 1):
+        self.tokens = min(self.capacity, self.tokens + min(cost, self.capacity))
+
+    def wait_time(self, now: float, cost: float = 1) -> float:
+        self._refill(now)
+        return max(0.0, (min(cost, self.capacity) - self.tokens) / self.rate) if self.rate else float("inf")
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+GENERATION_ENDPOINTS = {CreateFlow.confirm.state: "/api/v1/image/create", EditFlow.confirm.state: "/api/v1/image/edit"}
+
+def generation_endpoint(event, raw_state):
+    # Какие апдейты запускают запрос к бэкенду
+    if isinstance(event, CallbackQuery):
+        if event.data and event.data.startswith("regenerate:"):
+            return "/api/v1/image/create"
+        if event.data == "re_edit":
+            return "/api/v1/image/edit"
+    elif isinstance(event, Message) and event.text == "✅ Подтвердить":
+        return GENERATION_ENDPOINTS.get(raw_state)
+    return None
+
+async def generation_cost(endpoint: str, data: dict) -> int:
+    # Сколько запросов к бэкенду стоит генерация: create делает по запросу на вариант
+    state = data.get("state")
+    if endpoint != "/api/v1/image/create" or state is None:
+        return 1
+    return (await state.get_data()).get("variants", 1)
+
+class RateLimitMiddleware(BaseMiddleware):
+    # Генерации ограничены token bucket'ами: на пользователя, на эндпоинт и общим.
+    # Лишнее нажатие получает мгновенный ответ и до бэкенда не доходит.
+    CLEANUP_INTERVAL_SEC = 60
+
+    def __init__(self, user_limit: tuple, endpoint_limits: dict, global_limit: tuple):
+        # лимит — (в минуту, запас); 0 в минуту — уровень отключён
+        self.user_limit = user_limit
+        self.limits = {**endpoint_limits, "global": global_limit}
+        self._users: dict[int, TokenBucket] = {}
+        self._buckets: dict[str, TokenBucket] = {}
+        self._busy: dict[int, int] = {}  # user_id -> хендлеров генерации, ещё не зарегистрировавших задачу
+        self._last_cleanup = time.monotonic()
+
+    def active_users(self) -> int:
+        return len(self._users)
+
+    def _take_shared(self, name: str, cost: float) -> bool:
+        per_min, burst = self.limits[name]
+        if not per_min:
+            return True
+        # Между шардами эндпоинтные и общий лимиты делятся через SharedState
+        if shared_state:
+            return shared_state.take(f"rate:{name}", per_min / 60, burst, min(cost, burst))
+        bucket = self._buckets.get(name)
+        if bucket is None:
+            bucket = self._buckets[name] = TokenBucket(per_min / 60, burst)
+        return bucket.take(time.monotonic(), cost)
+
+    def _refund_shared(self, name: str, cost: float):
+        per_min, burst = self.limits[name]
+        if not per_min:
             return
-        b = decode_b64_image(img_b64)
-        if b:
-            await message.answer_photo(BufferedInputFile(b, filename="edited.png"))
-        await message.answer(
-            f"⭐ <b>Изображение успешно отредактировано</b>\n\n"
-            f"• <b>Инструкция:</b> {data['prompt']}\n\n"
-            f"💡 <b>Что дальше?</b>\nВыберите действие кнопками ниже.",
-            parse_mode="HTML",
-            reply_markup=kb_after_edit()
-        )
-    except Exception as e:
-        logger.error(f"edit_confirmed: ошибка - {e}", exc_info=True)
-        await wait_msg.delete()
-        await message.answer(
-            "❌ <b>Сервер перегружен.</b>\nПопробуй ещё раз через минуту.",
-            parse_mode="HTML"
+        if shared_state:
+            shared_state.add(f"rate:{name}", min(cost, burst), burst)
+        else:
+            self._buckets[name].refund(cost)
+
+    def _take(self, user_id: int, endpoint: str, now: float, cost: float = 1):
+        # -> None, если прошли все уровни, иначе название уровня, который не пустил
+        per_min, burst = self.user_limit
+        bucket = None
+        if per_min:
+            bucket = self._users.get(user_id)
+            if bucket is None:
+                bucket = self._users[user_id] = TokenBucket(per_min / 60, burst)
+            if not bucket.take(now, cost):
+                return "user"
+        if not self._take_shared(endpoint, cost):
+            scope = "endpoint"
+        elif not self._take_shared("global", cost):
+            self._refund_shared(endpoint, cost)
+            scope = "global"
+        else:
+            return None
+        if bucket:
+            bucket.refund(cost)
+        return scope
+
+    def _cleanup(self, now: float):
+        # Полные ведра ничем не отличаются от новых — храним только активных пользователей
+        self._last_cleanup = now
+        for user_id in [user_id for user_id, bucket in self._users.items() if bucket.is_full(now)]:
+            del self._users[user_id]
+
+    async def __call__(self, handler, event, data):
+        endpoint = generation_endpoint(event, data.get("raw_state"))
+        if endpoint is None:
+            return await handler(event, data)
+        user_id = event.from_user.id
+        now = time.monotonic()
+        if now - self._last_cleanup >= self.CLEANUP_INTERVAL_SEC:
+            self._cleanup(now)
+        # Резерв ставится синхронно до первого await хендлера и снимается, когда задача уже
+        # в generation_jobs, — между двумя быстрыми нажатиями не остаётся окна
+        if self._busy.get(user_id, 0) + generation_jobs.active(user_id) >= GEN_PER_USER_LIMIT:
+            RATE_LIMITED.labels("duplicate").inc()
+            return await self._reject(event, "⏳ Генерация уже идёт — дождись результата")
+        self._busy[user_id] = self._busy.get(user_id, 0) + 1
+        try:
+            # Каждый вариант — отдельный запрос к бэкенду и отдельный токен
+            cost = await generation_cost(endpoint, data)
+            now = time.monotonic()
+            scope = self._take(user_id, endpoint, now, cost)
+            if scope == "user":
+                RATE_LIMITED.labels(scope).inc()
+                wait = int(self._users[user_id].wait_time(now, cost)) + 1
+                return await self._reject(event, f"⏳ Слишком часто. Попробуй через {wait} сек")
+            if scope:
+                RATE_LIMITED.labels(scope).inc()
+                return await self._reject(event, "⏳ Сервер перегружен. Попробуй через минуту")
+            return await handler(event, data)
+        finally:
+            self._busy[user_id] -= 1
+            if not self._busy[user_id]:
+                del self._busy[user_id]
+
+    async def _reject(self, event, text: str):
+        # У CallbackQuery это всплывающая подсказка, у Message — обычный ответ
+        await event.answer(text)
+
+rate_limiter = RateLimitMiddleware(
+    (RATE_USER_PER_MIN, RATE_USER_BURST),
+    {"/api/v1/image/create": (RATE_CREATE_PER_MIN, RATE_ENDPOINT_BURST), "/api/v1/image/edit": (RATE_EDIT_PER_MIN, RATE_ENDPOINT_BURST)},
+    (RATE_GLOBAL_PER_MIN, RATE_GLOBAL_BURST),
+)
+
+# ============ ЗАПУСК ============
+class UpdateLimiter(BaseMiddleware):
+    # Ограничивает число одновременно обрабатываемых апдейтов и считает их для drain
+    def __init__(self, limit: int):
+        self._semaphore = asyncio.Semaphore(limit)
+        self.in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    async def __call__(self, handler, event, data):
+        async with self._semaphore:
+            self.in_flight += 1
+            self._idle.clear()
+            try:
+                return await handler(event, data)
+            finally:
+                self.in_flight -= 1
+                if not self.in_flight:
+                    self._idle.set()
+
+    async def drain(self, timeout: float) -> bool:
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class RequestIdMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        request_id_var.set(f"u{event.update_id}")
+        return await handler(event, data)
+
+update_limiter = UpdateLimiter(MAX_CONCURRENT_UPDATES)
+_draining = False
+
+async def health_handler(request: web.Request) -> web.Response:
+    return web.json_response({"status": "ok"})
+
+async def ready_handler(request: web.Request) -> web.Response:
+    ready = not _draining and http_client is not None and not http_client.is_closed
+    body = {"ready": ready, "in_flight_updates": update_limiter.in_flight, "queue": job_queue.stats(), "jobs": generation_jobs.stats()}
+    return web.json_response(body, status=200 if ready else 503)
+
+async def wait_for_stop_signal():
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    await stop.wait()
+
+async def serve_webhook(app: web.Application, bot: Bot, allowed_updates: list) -> web.AppRunner:
+    ssl_context = None
+    if WEBHOOK_SSL_CERT:
+        ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        ssl_context.load_cert_chain(WEBHOOK_SSL_CERT, WEBHOOK_SSL_KEY)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT, ssl_context=ssl_context).start()
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+            certificate=FSInputFile(WEBHOOK_SSL_CERT) if WEBHOOK_SSL_CERT and WEBHOOK_SELF_SIGNED else None,
+            secret_token=WEBHOOK_SECRET or None,
+            max_connections=WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=allowed_updates,
         )
-        await show_main_menu(message, state)
+    logger.info("serve_webhook: слушаю %s:%s%s", WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH)
+    return runner
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    global _draining
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET or None).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    app.router.add_get("/healthz", health_handler)
+    app.router.add_get("/readyz", ready_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    runner = await serve_webhook(app, bot, dp.resolve_used_update_types())
+    await wait_for_stop_signal()
+
+    # readyz отдаёт 503, балансировщик уводит трафик, начатые генерации дорабатывают
+    _draining = True
+    logger.info("run_webhook: завершение, ждём %s апдейтов в работе", update_limiter.in_flight)
+    if not await update_limiter.drain(WEBHOOK_DRAIN_TIMEOUT_SEC):
+        logger.warning("run_webhook: не дождались завершения %s апдейтов", update_limiter.in_flight)
+    # on_shutdown SimpleRequestHandler закрывает сессию бота — фоновые генерации дожидаемся раньше
+    await generation_jobs.drain(WEBHOOK_DRAIN_TIMEOUT_SEC)
+    await runner.cleanup()
+
+async def start_metrics_server(port: int = METRICS_PORT, ready=ready_handler) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/healthz", health_handler)
+    app.router.add_get("/readyz", ready)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, port).start()
+    logger.info("start_metrics_server: /metrics на %s:%s", METRICS_HOST, port)
+    return runner
+
+def build_bot() -> Bot:
+    if TELEGRAM_API_URL:
+        return Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+    return Bot(token=BOT_TOKEN)
+
+async def consume_updates(dp: Dispatcher, bot: Bot, updates):
+    # Шард получает сырые апдейты от супервизора; None в очереди, SIGTERM
+    # или смерть супервизора — сигнал остановки
+    global _draining
+    loop = asyncio.get_running_loop()
+    reader = ThreadPoolExecutor(max_workers=1, thread_name_prefix="shard-updates")
+    tasks = set()
+    stop = threading.Event()
+    loop.add_signal_handler(signal.SIGTERM, stop.set)
+
+    def next_update():
+        while not stop.is_set():
+            try:
+                return updates.get(timeout=SHARD_PARENT_CHECK_SEC)
+            except Empty:
+                parent = multiprocessing.parent_process()
+                if parent is not None and not parent.is_alive():
+                    # Супервизор убит (SIGKILL, OOM) и не успел прислать None
+                    logger.warning("consume_updates: супервизор завершился, останавливаю шард")
+                    return None
+        return None
+
+    async def feed(raw: dict):
+        try:
+            await dp.feed_raw_update(bot, raw)
+        except Exception:
+            logger.exception("consume_updates: ошибка в апдейте %s", raw.get("update_id"))
 
-async def main():
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    try:
+        while (raw := await loop.run_in_executor(reader, next_update)) is not None:
+            task = asyncio.create_task(feed(json.loads(raw)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        loop.remove_signal_handler(signal.SIGTERM)
+        reader.shutdown(wait=False)
+    _draining = True
+    if tasks:
+        logger.info("consume_updates: завершение, ждём %s апдейтов в работе", len(tasks))
+        _, pending = await asyncio.wait(tasks, timeout=WEBHOOK_DRAIN_TIMEOUT_SEC)
+        if pending:
+            logger.warning("consume_updates: не дождались завершения %s апдейтов", len(pending))
+
+async def main(mode: str = BOT_MODE, shard=None):
+    # shard — (номер, очередь апдейтов), когда процесс запущен супервизором
+    global shared_state
+    configure_logging()
+    bot = build_bot()
+    dp = Dispatcher(storage=build_storage())
+    stats_collector.storage = dp.storage
+    # Хранилище закрываем сами после фоновых генераций: они ещё пишут результаты в FSM
+    dp.shutdown.handlers = [h for h in dp.shutdown.handlers if h.callback != dp.fsm.close]
+    dp.update.outer_middleware(RequestIdMiddleware())
+    dp.update.outer_middleware(update_limiter)
+    dp.message.outer_middleware(rate_limiter)
+    dp.callback_query.outer_middleware(rate_limiter)
     dp.include_router(router)
-    logger.info("Бот запущен")
-    await dp.start_polling(bot)
+    if shard:
+        shared_state = SharedState(SHARED_STATE_PATH)
+        subscription_cache.shared = shared_state
+    create_http_client()
+    await job_queue.start()
+    stats_task = asyncio.create_task(log_pool_stats(POOL_STATS_INTERVAL_SEC)) if POOL_STATS_INTERVAL_SEC > 0 else None
+    lag_task = asyncio.create_task(monitor_loop_lag(LOOP_LAG_INTERVAL_SEC)) if LOOP_LAG_INTERVAL_SEC > 0 else None
+    metrics_port = METRICS_PORT + 1 + shard[0] if shard else METRICS_PORT
+    metrics_runner = await start_metrics_server(metrics_port) if mode != "webhook" and METRICS_PORT > 0 else None
+    logger.info("Бот запущен (%s)", f"шард {shard[0]}" if shard else mode)
+    try:
+        if shard:
+            await consume_updates(dp, bot, shard[1])
+        elif mode == "webhook":
+            await run_webhook(dp, bot)
+        else:
+            # Сессию закрываем сами: фоновые генерации ещё отправляют результаты после остановки polling
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(), close_bot_session=False)
+    finally:
+        if stats_task:
+            stats_task.cancel()
+        if lag_task:
+            lag_task.cancel()
+        # Апдейты уже обработаны, а фоновые генерации ещё могут дорабатывать (в webhook — уже дождались)
+        await generation_jobs.drain(WEBHOOK_DRAIN_TIMEOUT_SEC)
+        await bot.session.close()
+        await dp.storage.close()
+        await job_queue.stop()
+        await close_http_client()
+        shutdown_image_executor()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        if shard:
+            shared_state.close()
 
-if __name__ == "__main__":
-    asyncio.run(main())
+# ============ ШАРДИРОВАНИЕ ============
+SHARD_UPDATES = Counter("akula_shard_updates_total", "Апдейты, переданные супервизором в шард", ["shard"])
+
+def shard_for(user_id: int, shards: int) -> int:
+    digest = hashlib.blake2b(str(user_id).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shards
+
+def update_user_id(raw: dict):
+    # Чьё FSM затрагивает апдейт; для chat_member — участник канала, а не тот, кто его изменил
+    for name, event in raw.items():
+        if name == "update_id" or not isinstance(event, dict):
+            continue
+        if isinstance(event.get("new_chat_member"), dict):
+            return event["new_chat_member"]["user"]["id"]
+        for field in ("from", "user", "chat"):
+            if isinstance(event.get(field), dict):
+                return event[field]["id"]
+    return None
+
+def run_shard(index: int, updates):
+    # Точка входа процесса-шарда. Ctrl+C ловит супервизор и останавливает шарды через очередь,
+    # поэтому он не обрывает начатые генерации; SIGTERM, адресованный шарду, запускает такое же завершение.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(main("shard", (index, updates)))
+
+class ShardSupervisor:
+    def __init__(self, shards: int):
+        self.shards = shards
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue() for _ in range(shards)]
+        self.processes: list = [None] * shards
+        self.restarts = 0
+
+    def _spawn(self, index: int):
+        process = self._ctx.Process(target=run_shard, args=(index, self.queues[index]), name=f"shard-{index}")
+        process.start()
+        self.processes[index] = process
+
+    def start(self):
+        for index in range(self.shards):
+            self._spawn(index)
+        logger.info("ShardSupervisor: запущено %s шардов", self.shards)
+
+    def route(self, raw: dict):
+        # Все апдейты пользователя попадают в один шард: его FSM и очередь генераций живут там
+        user_id = update_user_id(raw)
+        index = shard_for(user_id, self.shards) if user_id is not None else 0
+        self.queues[index].put(json.dumps(raw, ensure_ascii=False))
+        SHARD_UPDATES.labels(str(index)).inc()
+
+    async def watch(self):
+        # Упавший шард перезапускается, апдейты его пользователей ждут в очереди
+        while True:
+            await asyncio.sleep(SHARD_RESTART_DELAY_SEC)
+            for index, process in enumerate(self.processes):
+                if not process.is_alive():
+                    logger.error("ShardSupervisor: шард %s завершился с кодом %s, перезапускаю", index, process.exitcode)
+                    self.restarts += 1
+                    self._spawn(index)
 
+    def stats(self) -> dict:
+        return {"shards": self.shards, "alive": sum(p.is_alive() for p in self.processes), "restarts": self.restarts}
+
+    async def stop(self, timeout: float):
+        for queue in self.queues:
+            queue.put(None)
+        deadline = time.monotonic() + timeout
+        for index, process in enumerate(self.processes):
+            await asyncio.to_thread(process.join, max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                logger.warning("ShardSupervisor: шард %s не остановился за %s с", index, timeout)
+                process.kill()
+
+async def poll_updates(bot: Bot, supervisor: ShardSupervisor, allowed_updates: list, polling_timeout: int = 30):
+    offset, failures = None, 0
+    while True:
+        try:
+            updates = await bot.get_updates(
+                offset=offset, timeout=polling_timeout, allowed_updates=allowed_updates,
+                request_timeout=int(bot.session.timeout + polling_timeout),
+            )
+        except Exception as e:
+            failures += 1
+            logger.error("poll_updates: ошибка getUpdates - %s", e)
+            await asyncio.sleep(_backoff_delay(min(failures, 10)))
+            continue
+        failures = 0
+        for update in updates:
+            supervisor.route(update.model_dump(mode="json", by_alias=True, exclude_none=True))
+            offset = update.update_id + 1
+
+async def supervise(mode: str, shards: int):
+    configure_logging()
+    bot = build_bot()
+    supervisor = ShardSupervisor(shards)
+    supervisor.start()
+    allowed_updates = router.resolve_used_update_types()
+
+    async def ready(request: web.Request) -> web.Response:
+        stats = supervisor.stats()
+        return web.json_response(stats, status=200 if stats["alive"] == shards else 503)
+
+    async def route_webhook(request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        supervisor.route(await request.json())
+        return web.Response()
+
+    tasks = [asyncio.create_task(supervisor.watch())]
+    if mode == "webhook":
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, route_webhook)
+        app.router.add_get("/healthz", health_handler)
+        app.router.add_get("/readyz", ready)
+        app.router.add_get("/metrics", metrics_handler)
+        runner = await serve_webhook(app, bot, allowed_updates)
+    else:
+        tasks.append(asyncio.create_task(poll_updates(bot, supervisor, allowed_updates)))
+        runner = await start_metrics_server(ready=ready) if METRICS_PORT > 0 else None
+    try:
+        await wait_for_stop_signal()
+    finally:
+        for task in tasks:
+            task.cancel()
+        if runner:
+            await runner.cleanup()
+        await supervisor.stop(WEBHOOK_DRAIN_TIMEOUT_SEC)
+        await bot.session.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Akula Bot")
+    parser.add_argument("--mode", choices=["polling", "webhook"], default=BOT_MODE)
+    parser.add_argument("--shards", type=int, default=SHARDS, help="число процессов-шардов (1 — без супервизора)")
+    args = parser.parse_args()
+    if args.shards > 1:
+        asyncio.run(supervise(args.mode, args.shards))
+    else:
+        asyncio.run(main(args.mode))
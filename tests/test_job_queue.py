@@ -0,0 +1,162 @@
+import asyncio
+
+import pytest
+
+from main import JobQueue, QueueFullError
+
+def run(scenario, workers=1, max_depth=10):
+    async def wrapper():
+        queue = JobQueue(workers=workers, per_user_limit=1, max_depth=max_depth)
+        await queue.start()
+        try:
+            await scenario(queue)
+        finally:
+            await queue.stop()
+    asyncio.run(wrapper())
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_round_robin_between_users():
+    async def scenario(queue):
+        order = []
+        gate = asyncio.Event()
+
+        def job(name):
+            async def factory():
+                if name == "blocker":
+                    await gate.wait()
+                order.append(name)
+            return factory
+
+        blocker = asyncio.create_task(queue.submit(0, job("blocker")))
+        await settle()
+        tasks = [asyncio.create_task(queue.submit(user, job(f"{user}-{i}"))) for user, i in ((1, 0), (1, 1), (1, 2), (2, 0), (2, 1), (3, 0))]
+        await settle()
+        gate.set()
+        await asyncio.gather(blocker, *tasks)
+        assert order == ["blocker", "1-0", "2-0", "3-0", "1-1", "2-1", "1-2"]
+    run(scenario)
+
+def test_positions_follow_round_robin():
+    async def scenario(queue):
+        gate = asyncio.Event()
+        positions = {}
+
+        async def wait():
+            await gate.wait()
+
+        blocker = asyncio.create_task(queue.submit(0, wait))
+        await settle()
+        tasks = [
+            asyncio.create_task(queue.submit(user, wait, lambda position, name=name: positions.__setitem__(name, position)))
+            for user, name in ((1, "a1"), (1, "a2"), (2, "b1"))
+        ]
+        await settle()
+        assert positions == {"a1": 1, "a2": 3, "b1": 2}
+        gate.set()
+        await asyncio.gather(blocker, *tasks)
+        assert positions == {"a1": 0, "a2": 0, "b1": 0}
+    run(scenario)
+
+def test_per_user_limit_leaves_workers_for_others():
+    async def scenario(queue):
+        gate = asyncio.Event()
+        started = []
+
+        def job(name):
+            async def factory():
+                started.append(name)
+                await gate.wait()
+            return factory
+
+        tasks = [asyncio.create_task(queue.submit(user, job(name))) for user, name in ((1, "a1"), (1, "a2"), (2, "b1"))]
+        await settle()
+        assert started == ["a1", "b1"]
+        assert queue.stats() == {"depth": 1, "in_flight": 2, "users": 1}
+        gate.set()
+        await asyncio.gather(*tasks)
+        assert started == ["a1", "b1", "a2"]
+    run(scenario, workers=2)
+
+def test_queue_full():
+    async def scenario(queue):
+        gate = asyncio.Event()
+
+        async def wait():
+            await gate.wait()
+
+        running = asyncio.create_task(queue.submit(1, wait))
+        await settle()
+        waiting = [asyncio.create_task(queue.submit(2, wait)) for _ in range(2)]
+        await settle()
+        with pytest.raises(QueueFullError):
+            await queue.submit(3, wait)
+        gate.set()
+        await asyncio.gather(running, *waiting)
+    run(scenario, max_depth=2)
+
+def test_cancel_while_queued_leaves_the_queue():
+    async def scenario(queue):
+        gate = asyncio.Event()
+        ran = []
+
+        async def wait():
+            await gate.wait()
+
+        async def record():
+            ran.append("queued")
+
+        running = asyncio.create_task(queue.submit(1, wait))
+        queued = asyncio.create_task(queue.submit(2, record))
+        await settle()
+        assert queue.stats()["depth"] == 1
+        queued.cancel()
+        await settle()
+        assert queue.stats()["depth"] == 0
+        gate.set()
+        await running
+        await settle()
+        assert ran == []
+    run(scenario)
+
+def test_cancel_while_running_cancels_task_and_frees_worker():
+    async def scenario(queue):
+        cancelled = asyncio.Event()
+
+        async def forever():
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        async def quick():
+            return "done"
+
+        running = asyncio.create_task(queue.submit(1, forever))
+        await settle()
+        next_job = asyncio.create_task(queue.submit(2, quick))
+        await settle()
+        assert queue.stats()["in_flight"] == 1 and queue.stats()["depth"] == 1
+        running.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await running
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert await asyncio.wait_for(next_job, 1) == "done"
+        assert queue.stats() == {"depth": 0, "in_flight": 0, "users": 0}
+    run(scenario)
+
+def test_job_exception_reaches_submitter():
+    async def scenario(queue):
+        async def fail():
+            raise ValueError("boom")
+
+        async def quick():
+            return 42
+
+        with pytest.raises(ValueError, match="boom"):
+            await queue.submit(1, fail)
+        assert await queue.submit(1, quick) == 42
+    run(scenario)
@@ -0,0 +1,90 @@
+import asyncio
+import os
+
+import pytest
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.storage.base import StorageKey
+
+from main import BlobRef, FileStorage, SQLiteStorage, load_blob
+
+KEY = StorageKey(bot_id=1, chat_id=2, user_id=2)
+IMAGE = bytes(range(256)) * 400
+
+@pytest.fixture(params=["sqlite", "file"])
+def open_storage(request, tmp_path):
+    def factory():
+        if request.param == "sqlite":
+            return SQLiteStorage(str(tmp_path / "fsm.sqlite3"))
+        return FileStorage(str(tmp_path / "fsm"))
+    return factory
+
+def rows(storage) -> int:
+    if isinstance(storage, SQLiteStorage):
+        return storage.read_conn.execute("SELECT COUNT(*) FROM fsm").fetchone()[0]
+    return sum(1 for entry in os.scandir(storage.path) if entry.name.endswith(".json"))
+
+def count_puts(storage) -> list:
+    puts = []
+    write = storage.blobs._write
+    storage.blobs._write = lambda digest, data: (puts.append(digest), write(digest, data))
+    return puts
+
+def test_bytes_survive_reopen(open_storage):
+    async def scenario():
+        storage = open_storage()
+        state = FSMContext(storage, KEY)
+        await state.set_state("EditFlow:confirm")
+        await state.update_data(image=IMAGE, variant_images=[b"a", b"b"], prompt="акула")
+        await storage.close()
+
+        storage = open_storage()
+        state = FSMContext(storage, KEY)
+        data = await state.get_data()
+        assert await state.get_state() == "EditFlow:confirm"
+        assert data["prompt"] == "акула"
+        assert isinstance(data["image"], BlobRef)
+        assert await load_blob(state, data["image"]) == IMAGE
+        assert await load_blob(state, data["variant_images"]) == [b"a", b"b"]
+        await storage.close()
+    asyncio.run(scenario())
+
+def test_update_keeps_blob_ref(open_storage):
+    async def scenario():
+        storage = open_storage()
+        state = FSMContext(storage, KEY)
+        puts = count_puts(storage)
+        await state.update_data(image=IMAGE, variant_images=[b"a", b"b"])
+        assert len(puts) == 3
+        data = await state.update_data(prompt="новый промпт")
+        assert len(puts) == 3
+        assert isinstance(data["image"], BlobRef)
+        assert await load_blob(state, (await state.get_data())["image"]) == IMAGE
+        await storage.close()
+    asyncio.run(scenario())
+
+def test_clear_deletes_record(open_storage):
+    async def scenario():
+        storage = open_storage()
+        state = FSMContext(storage, KEY)
+        await state.set_state("CreateFlow:confirm")
+        await state.update_data(image=IMAGE, prompt="акула")
+        assert rows(storage) == 1
+        await state.clear()
+        assert rows(storage) == 0
+        assert await state.get_state() is None
+        assert await state.get_data() == {}
+        await storage.close()
+    asyncio.run(scenario())
+
+def test_evicted_blob_drops_key(open_storage):
+    async def scenario():
+        storage = open_storage()
+        state = FSMContext(storage, KEY)
+        await state.update_data(image=IMAGE, last_result=b"result", variant_images=[b"a"], prompt="акула", note=None)
+        await storage._io(storage.blobs.gc, 10 ** 12)
+        data = await state.get_data()
+        assert "image" not in data and "last_result" not in data
+        assert data["variant_images"] == [None]
+        assert data["prompt"] == "акула" and data["note"] is None
+        await storage.close()
+    asyncio.run(scenario())
@@ -0,0 +1,104 @@
+import base64
+import json
+import os
+
+import pytest
+
+from main import StreamingImageDecoder
+
+CHUNK_SIZES = [1, 3, 7, 4096]
+
+def image(seed: int, size: int = 3000) -> bytes:
+    return os.urandom(size) if seed < 0 else bytes((seed * 31 + i * 7) % 256 for i in range(size))
+
+def b64(data: bytes) -> str:
+    return base64.b64encode(data).decode()
+
+def decode(body: bytes, chunk_size: int, **kwargs) -> dict:
+    decoder = StreamingImageDecoder(**kwargs)
+    for i in range(0, len(body), chunk_size):
+        decoder.feed(body[i:i + chunk_size])
+    return decoder.finish()
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_single_image_and_other_fields(chunk_size):
+    data = image(1)
+    body = json.dumps({"status": "ok", "image_b64": b64(data), "meta": {"seed": 42, "tags": ["a", "b"]}}).encode()
+    result = decode(body, chunk_size)
+    assert result == {"status": "ok", "meta": {"seed": 42, "tags": ["a", "b"]}, "images": [data]}
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("mime", ["image/png", "image/jpeg"])
+def test_data_uri_prefix(chunk_size, mime):
+    data = image(2)
+    body = json.dumps({"image_b64": f"data:{mime};base64,{b64(data)}"}).encode()
+    assert decode(body, chunk_size)["images"] == [data]
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_escaped_slashes_and_line_breaks(chunk_size):
+    # Некоторые сериализаторы экранируют «/» и режут base64 на строки
+    data = image(3)
+    encoded = b64(data)
+    escaped = "\\n".join(encoded[i:i + 76] for i in range(0, len(encoded), 76)).replace("/", "\\/")
+    assert "\\/" in escaped
+    body = ('{"image_b64": "data:image\\/png;base64,' + escaped + '"}').encode()
+    assert decode(body, chunk_size)["images"] == [data]
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_list_of_images(chunk_size):
+    images = [image(4), image(5, 10), image(6, 1)]
+    body = json.dumps({"image_b64": [b64(i) for i in images], "count": 3}).encode()
+    assert decode(body, chunk_size) == {"count": 3, "images": images}
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_list_with_nulls_and_empty_strings(chunk_size):
+    data = image(7)
+    body = json.dumps({"image_b64": [None, b64(data), ""]}).encode()
+    assert decode(body, chunk_size)["images"] == [data]
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("value", [None, "", []])
+def test_no_image(chunk_size, value):
+    body = json.dumps({"image_b64": value, "error": "nsfw"}).encode()
+    assert decode(body, chunk_size) == {"error": "nsfw", "images": []}
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_key_name_elsewhere_is_not_an_image(chunk_size):
+    data = image(8)
+    body = json.dumps({
+        "note": "image_b64",
+        "nested": {"image_b64": "not an image \" with \\ escapes"},
+        "other": ["image_b64"],
+        "image_b64": b64(data),
+    }).encode()
+    result = decode(body, chunk_size)
+    assert result["images"] == [data]
+    assert result["nested"] == {"image_b64": "not an image \" with \\ escapes"}
+    assert result["note"] == "image_b64" and result["other"] == ["image_b64"]
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_random_payload_matches_json(chunk_size):
+    data = image(-1, 5000)
+    body = json.dumps({"image_b64": b64(data)}, indent=2).encode()
+    assert decode(body, chunk_size)["images"] == [data]
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+@pytest.mark.parametrize("cut", [1, 20, -40, -2, -1])
+def test_truncated_body(chunk_size, cut):
+    body = json.dumps({"status": "ok", "image_b64": b64(image(9))}).encode()
+    with pytest.raises(ValueError):
+        decode(body[:cut], chunk_size)
+
+@pytest.mark.parametrize("chunk_size", CHUNK_SIZES)
+def test_size_limit(chunk_size):
+    images = [image(10, 600), image(11, 600)]
+    body = json.dumps({"image_b64": [b64(i) for i in images]}).encode()
+    assert decode(body, chunk_size, max_bytes=1200)["images"] == images
+    with pytest.raises(ValueError, match="лимита"):
+        decode(body, chunk_size, max_bytes=1000)
+
+def test_custom_key():
+    data = image(12)
+    body = json.dumps({"image_b64": "ignored", "result": b64(data)}).encode()
+    result = decode(body, 5, key="result")
+    assert result == {"image_b64": "ignored", "images": [data]}